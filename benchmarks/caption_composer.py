@@ -0,0 +1,78 @@
+"""
+Microbenchmark of the caption composition: handlers/caption.py against the len() based code it replaced,
+which put the link entity at the wrong offset as soon as the text had characters outside the BMP (most emoji).
+
+Usage (from the project root):
+    python -m benchmarks.caption_composer [--length 100 1000 4000] [--checks 10000] [--number 2000]
+
+Before timing, the share of --checks random texts (ASCII, Cyrillic, emoji and combining marks) the old code
+linked wrongly is reported. The composer itself is tested in tests/test_caption.py.
+Timings are in microseconds per message, for texts of --length characters with one emoji in ten.
+"""
+import argparse
+import random
+import timeit
+
+from aiogram.types import MessageEntity
+
+from config import LINK, LINK_TEXT
+from handlers.caption import CAPTION_LIMIT, TEXT_LIMIT, composer, utf16_length
+
+ALPHABET = 'abc xyz,.' + 'абв где' + '😀🎉👍🏻🇺🇦' + 'é'
+
+
+def len_compose(text: str | None, entities: list[MessageEntity] | None) -> tuple[str, list[MessageEntity]]:
+    """The previous code of the handlers"""
+    text = text if text else ""
+    text += f"\n\n{LINK_TEXT}"
+    entities = list(entities) if entities else []
+    start_index = len(text) - len(LINK_TEXT)
+    entities.append(MessageEntity(type="text_link", offset=start_index, length=len(LINK_TEXT), url=LINK))
+    return text, entities
+
+
+def link_is_correct(text: str, entities: list[MessageEntity], limit: int) -> bool:
+    link = entities[-1]
+    encoded = text.encode('utf-16-le')
+    linked = encoded[link.offset * 2:(link.offset + link.length) * 2].decode('utf-16-le', errors='replace')
+    return linked == LINK_TEXT and link.url == LINK and utf16_length(text) <= limit
+
+
+def old_error_rate(count: int) -> float:
+    """Share of random texts the old code got wrong"""
+    rng = random.Random(0)
+    wrong = 0
+    for _ in range(count):
+        text = ''.join(rng.choices(ALPHABET, k=rng.randrange(0, 1500)))
+        limit = rng.choice((TEXT_LIMIT, CAPTION_LIMIT))
+        if not link_is_correct(*len_compose(text, None), limit):
+            wrong += 1
+    return wrong / count
+
+
+def measure(function, number: int) -> float:
+    """Best of 5 runs, microseconds per call"""
+    return min(timeit.repeat(function, number=number, repeat=5)) / number * 1e6
+
+
+def main(args):
+    wrong = old_error_rate(args.checks)
+    print(f"{args.checks} random texts: len() wrong on {wrong:.1%}\n")
+
+    print(f"{'length':>8}  {'len() us':>10}{'composer us':>13}")
+    entities = [MessageEntity(type='bold', offset=0, length=4)]
+    for length in args.length:
+        text = ''.join('😀' if i % 10 == 9 else 'a' for i in range(length))
+        old = measure(lambda: len_compose(text, entities), args.number)
+        new = measure(lambda: composer.compose(text, entities, 10 ** 6), args.number)
+        print(f"{length:>8}  {old:>10.2f}{new:>13.2f}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--length", type=int, nargs="+", default=[100, 1000, 4000], help="characters per text")
+    parser.add_argument("--checks", type=int, default=10000, help="random texts the old code is checked on")
+    parser.add_argument("--number", type=int, default=2000, help="calls per measurement")
+    args = parser.parse_args()
+
+    main(args)
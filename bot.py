@@ -1,67 +1,300 @@
 import asyncio
 import logging
+import multiprocessing
 import sys
+from datetime import datetime
+from aiohttp import web
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
 from aiogram import Bot, Dispatcher
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
+from aiogram.fsm.storage.memory import MemoryStorage
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
 
-from database.engine import create_db, session_maker, drop_db
+from database.cache import BanListener, user_cache
+from database.fsm_storage import PostgresStorage
+from database.engine import create_db, session_maker, drop_db, engine, prewarm_pool
+from database.orm_query import orm_get_recent_users
 
 from filters.admin_filter import AdminFilter
 from middlewares.acl import ACLMiddleware
 from handlers import user_handler, admin_handler, menu_processing
 
 from config import *
+from metrics import ALBUM_BUFFERED_GROUPS, SCHEDULER_JOBS, THROTTLE_CACHE_SIZE, USER_CACHE_HIT_RATE, \
+    USER_CACHE_USERS, setup_metrics_route, start_metrics_server
 from middlewares.db_middleware import DataBaseSession
+from middlewares.metrics_middleware import BotApiMetricsMiddleware, HandlerMetricsMiddleware
 from middlewares.album_middleware import AlbumMiddleware
 from middlewares.scheduler_middleware import SchedulerMiddleware
 from middlewares.throthling import ThrottlingMiddleware
+from middlewares.request_scheduler import RequestScheduler
+from middlewares.throttle_storage import MemoryThrottleStorage, PostgresThrottleStorage
+from scripts.clear_db_admin_chat import sweep_expired_suggestions
+from scripts.outbox import OutboxWorker
+from scripts.worker_pool import WorkerPool, consume, poll_updates, setup_webhook_route
 
 
-async def on_startup(bot: Bot, dp: Dispatcher, scheduler: AsyncIOScheduler):
-    await create_db()
+class BoundedRequestHandler(SimpleRequestHandler):
+    """Webhook handler that processes at most `max_in_flight` updates at the same time."""
+
+    def __init__(self, *args, max_in_flight: int, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.semaphore = asyncio.Semaphore(max_in_flight)
+
+    async def handle(self, request: web.Request) -> web.Response:
+        async with self.semaphore:
+            return await super().handle(request)
+
+    __call__ = handle
+
+
+async def on_startup(bot: Bot, dp: Dispatcher, scheduler: AsyncIOScheduler, worker_index: int | None = None):
+    """`worker_index` is set in the worker processes, the ingress process has already created the tables"""
+    if worker_index is None:
+        await create_db()
+    await prewarm_pool()
+    logging.info(f'Connection pool warmed: {engine.pool.status()}')
+
+    # Listening before the cache is warmed, so no ban made meanwhile is missed
+    dp['ban_listener'].start()
+    try:
+        await asyncio.wait_for(dp['ban_listener'].listening.wait(), BAN_LISTENER_TIMEOUT)
+    except asyncio.TimeoutError:
+        # LISTEN needs a session connection, behind pgbouncer in transaction mode it never works
+        await dp['ban_listener'].stop()
+        logging.warning(f'Ban listener is not listening after {BAN_LISTENER_TIMEOUT}s, bans made in other '
+                        f'processes take effect after USER_CACHE_TTL ({USER_CACHE_TTL}s)')
+    async with session_maker() as session:
+        user_cache.warm(await orm_get_recent_users(session, USER_CACHE_SIZE))
+    logging.info(f'User cache warmed: {user_cache.stats()}')
+
+    # Periodic jobs for all suggestions and outbox messages (in worker 0 only); the first run right away catches up
+    # on what expired during downtime
+    if not worker_index:
+        scheduler.add_job(sweep_expired_suggestions,
+                          trigger='interval',
+                          seconds=SWEEP_INTERVAL_SECONDS,
+                          next_run_time=datetime.now(),
+                          args=[bot, session_maker],
+                          id='sweep_expired_suggestions',
+                          replace_existing=True,
+                          max_instances=1,
+                          coalesce=True)
+        scheduler.add_job(dp['outbox'].sweep_dead_messages,
+                          trigger='interval',
+                          seconds=SWEEP_INTERVAL_SECONDS,
+                          next_run_time=datetime.now(),
+                          id='sweep_dead_outbox_messages',
+                          replace_existing=True,
+                          max_instances=1,
+                          coalesce=True)
     scheduler.start()
     logging.info('Scheduler started')
 
-async def on_shutdown(bot: Bot, scheduler: AsyncIOScheduler):
+    dp['outbox'].start()
+    logging.info('Outbox worker started')
+
+    if worker_index is None and USE_WEBHOOK and WEBHOOK_BASE_URL:
+        await bot.set_webhook(url=WEBHOOK_BASE_URL + WEBHOOK_PATH,
+                              secret_token=WEBHOOK_SECRET,
+                              max_connections=WEBHOOK_MAX_CONNECTIONS,
+                              allowed_updates=dp.resolve_used_update_types(),
+                              drop_pending_updates=DROP_PENDING_UPDATES)
+        logging.info('Webhook is set')
+
+async def on_shutdown(bot: Bot, dp: Dispatcher, scheduler: AsyncIOScheduler):
     scheduler.shutdown()
     logging.info('Scheduler stopped')
+    await dp['outbox'].stop()
+    logging.info('Outbox worker stopped')
+    await dp['ban_listener'].stop()
+    logging.info(f'User cache: {user_cache.stats()}')
     logging.info('bot is down')
 
 
-
-async def main():
-    bot = Bot(token=TOKEN)
-    dp = Dispatcher()
-
-    scheduler = AsyncIOScheduler()
+def create_dispatcher(bot: Bot, scheduler: AsyncIOScheduler, worker_index: int | None = None) -> Dispatcher:
+    if FSM_STORAGE == 'postgres':
+        fsm_storage = PostgresStorage(session_pool=session_maker, cache_ttl=FSM_CACHE_TTL,
+                                      flush_interval=FSM_FLUSH_INTERVAL)
+    else:
+        fsm_storage = MemoryStorage()
+    dp = Dispatcher(name="dispatcher", storage=fsm_storage)
+    # Handlers get the worker as `outbox` to wake it up after committing outbox messages
+    dp['outbox'] = OutboxWorker(bot, session_maker)
+    dp['ban_listener'] = BanListener(engine, user_cache)
 
     @dp.startup()
     async def startup_handler():
-        await on_startup(bot, dp, scheduler)
+        await on_startup(bot, dp, scheduler, worker_index)
 
     @dp.shutdown()
     async def shutdown_handler():
-        await on_shutdown(bot, scheduler)
+        await on_shutdown(bot, dp, scheduler)
+
+    if THROTTLE_STORAGE == 'postgres':
+        throttle_storage = PostgresThrottleStorage(session_pool=session_maker)
+    else:
+        throttle_storage = MemoryThrottleStorage()
+
+    album_middleware = AlbumMiddleware(latency=0.3)
+
+    # Metrics
+    dp.message.middleware(HandlerMetricsMiddleware())
+    dp.callback_query.middleware(HandlerMetricsMiddleware())
+    ALBUM_BUFFERED_GROUPS.set_function(lambda: album_middleware.buffered_groups)
+    if isinstance(throttle_storage, MemoryThrottleStorage):
+        THROTTLE_CACHE_SIZE.set_function(lambda: len(throttle_storage))
+    USER_CACHE_USERS.set_function(lambda: len(user_cache.users))
+    USER_CACHE_HIT_RATE.set_function(lambda: user_cache.hit_rate)
+    SCHEDULER_JOBS.set_function(lambda: len(scheduler.get_jobs()))
 
     # Using middlewares
     dp.update.middleware(DataBaseSession(session_pool=session_maker))
-    user_handler.user_router.message.middleware(AlbumMiddleware(latency=0.3))
+    user_handler.user_router.message.middleware(album_middleware)
     user_handler.user_router.message.middleware(ACLMiddleware())
-    user_handler.user_router.message.middleware(ThrottlingMiddleware())
+    user_handler.user_router.message.middleware(ThrottlingMiddleware(storage=throttle_storage))
     user_handler.user_router.message.middleware(SchedulerMiddleware(scheduler))
 
     # Using filters
     admin_handler.admin_router.message.filter(AdminFilter())
+    admin_handler.admin_router.callback_query.filter(AdminFilter())
 
     # Including routers
     admin_handler.admin_router.include_router(menu_processing.main_menu_router)
     dp.include_router(admin_handler.admin_router)
     dp.include_router(user_handler.user_router)
 
-    await bot.delete_webhook(drop_pending_updates=True)
+    return dp
+
+
+async def run_polling(bot: Bot, dp: Dispatcher):
+    if METRICS_ENABLED:
+        await start_metrics_server(METRICS_HOST, METRICS_PORT)
+    await bot.delete_webhook(drop_pending_updates=DROP_PENDING_UPDATES)
     await dp.start_polling(bot)
 
 
+async def run_webhook(bot: Bot, dp: Dispatcher):
+    """Serves updates sent by Telegram (or POSTed manually) to WEBAPP_HOST:WEBAPP_PORT + WEBHOOK_PATH."""
+    app = web.Application()
+    BoundedRequestHandler(dispatcher=dp,
+                          bot=bot,
+                          secret_token=WEBHOOK_SECRET,
+                          handle_in_background=False,
+                          max_in_flight=MAX_UPDATES_IN_FLIGHT).register(app, path=WEBHOOK_PATH)
+    if METRICS_ENABLED:
+        setup_metrics_route(app)
+    setup_application(app, dp, bot=bot)
+
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, host=WEBAPP_HOST, port=WEBAPP_PORT)
+    await site.start()
+    logging.info(f'Webhook server is listening on {WEBAPP_HOST}:{WEBAPP_PORT}{WEBHOOK_PATH}')
+
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await runner.cleanup()
+
+
+async def run_worker_process(index: int, updates: multiprocessing.Queue):
+    """A worker of WORKER_PROCESSES: handles the updates the ingress process puts in its queue"""
+    bot = create_bot()
+    scheduler = AsyncIOScheduler()
+    dp = create_dispatcher(bot, scheduler, worker_index=index)
+    if METRICS_ENABLED:
+        # Every process has its own registry, the ingress serves METRICS_PORT
+        await start_metrics_server(METRICS_HOST, METRICS_PORT + index + 1)
+
+    await dp.emit_startup(bot=bot)
+    logging.info(f'Worker {index} started')
+    try:
+        await consume(updates, lambda update: dp.feed_raw_update(bot, update), MAX_UPDATES_IN_FLIGHT)
+    finally:
+        await dp.emit_shutdown(bot=bot)
+        await bot.session.close()
+
+
+def run_worker(index: int, updates: multiprocessing.Queue):
+    logging.basicConfig(level=logging.INFO, stream=sys.stdout,
+                        format=f'worker-{index}:%(levelname)s:%(name)s:%(message)s')
+    asyncio.run(run_worker_process(index, updates))
+
+
+async def run_ingress(bot: Bot):
+    """Receives the updates and distributes them between WORKER_PROCESSES worker processes by chat id"""
+    await create_db()
+    await engine.dispose()
+
+    # Only for the update types, the dispatcher of the ingress handles nothing
+    allowed_updates = create_dispatcher(bot, AsyncIOScheduler()).resolve_used_update_types()
+    pool = WorkerPool(run_worker, processes=WORKER_PROCESSES, queue_size=WORKER_QUEUE_SIZE)
+    pool.start()
+    logging.info(f'Started {WORKER_PROCESSES} worker processes')
+
+    runner = None
+    try:
+        if USE_WEBHOOK:
+            app = web.Application()
+            setup_webhook_route(app, pool, WEBHOOK_PATH, WEBHOOK_SECRET)
+            if METRICS_ENABLED:
+                setup_metrics_route(app)
+            runner = web.AppRunner(app)
+            await runner.setup()
+            await web.TCPSite(runner, host=WEBAPP_HOST, port=WEBAPP_PORT).start()
+            if WEBHOOK_BASE_URL:
+                await bot.set_webhook(url=WEBHOOK_BASE_URL + WEBHOOK_PATH,
+                                      secret_token=WEBHOOK_SECRET,
+                                      max_connections=WEBHOOK_MAX_CONNECTIONS,
+                                      allowed_updates=allowed_updates,
+                                      drop_pending_updates=DROP_PENDING_UPDATES)
+            logging.info(f'Webhook server is listening on {WEBAPP_HOST}:{WEBAPP_PORT}{WEBHOOK_PATH}')
+            await asyncio.Event().wait()
+        else:
+            if METRICS_ENABLED:
+                runner = await start_metrics_server(METRICS_HOST, METRICS_PORT)
+            await bot.delete_webhook(drop_pending_updates=DROP_PENDING_UPDATES)
+            await poll_updates(bot, pool, allowed_updates)
+    finally:
+        await pool.stop()
+        logging.info('Worker processes stopped')
+        if runner is not None:
+            await runner.cleanup()
+        await bot.session.close()
+
+
+def create_bot() -> Bot:
+    if TELEGRAM_API_URL:
+        bot = Bot(token=TOKEN, session=AiohttpSession(api=TelegramAPIServer.from_base(TELEGRAM_API_URL)))
+    else:
+        bot = Bot(token=TOKEN)
+    if METRICS_ENABLED:
+        # Registered first, so the time includes waiting in the scheduler and its retries
+        bot.session.middleware(BotApiMetricsMiddleware())
+    bot.session.middleware(RequestScheduler(global_rate=TG_GLOBAL_RATE,
+                                            chat_rate=TG_CHAT_RATE,
+                                            chat_burst=TG_CHAT_BURST,
+                                            max_retries=TG_MAX_RETRIES))
+    return bot
+
+
+async def main():
+    bot = create_bot()
+    if WORKER_PROCESSES:
+        await run_ingress(bot)
+        return
+
+    scheduler = AsyncIOScheduler()
+    dp = create_dispatcher(bot, scheduler)
+
+    if USE_WEBHOOK:
+        await run_webhook(bot, dp)
+    else:
+        await run_polling(bot, dp)
+
+
 if __name__ == "__main__":
     logging.basicConfig(level=logging.INFO, stream=sys.stdout)
     asyncio.run(main())
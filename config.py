@@ -5,15 +5,97 @@ TOKEN = os.getenv("TOKEN")
 
 # Admin Chat
 ADMIN_USER_ID = os.getenv("ADMIN_USER_ID")
+# Moderators review suggestions in their own chats, comma separated ids; the admin alone by default
+MODERATOR_IDS = [int(moderator_id) for moderator_id in (os.getenv("MODERATOR_IDS") or ADMIN_USER_ID or "").split(",")
+                 if moderator_id.strip()]
+# "least_loaded" sends a new suggestion to the moderator with the fewest pending ones, "round_robin" takes turns
+MODERATOR_ASSIGNMENT = os.getenv("MODERATOR_ASSIGNMENT", "least_loaded")
 
 DATABASE_URL = os.getenv("DATABASE_URL")
+# SQLAlchemy engine and connection pool, see database/engine.py
+DB_ECHO = os.getenv("DB_ECHO", "false").lower() in ("1", "true", "yes")
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", 10))
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", 10))
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", 30))  # seconds to wait for a free connection
+DB_POOL_PRE_PING = os.getenv("DB_POOL_PRE_PING", "true").lower() in ("1", "true", "yes")
+DB_POOL_RECYCLE = int(os.getenv("DB_POOL_RECYCLE", 1800))  # seconds, -1 keeps connections forever
+# Connections opened on startup, at most DB_POOL_SIZE
+DB_POOL_PREWARM = int(os.getenv("DB_POOL_PREWARM", DB_POOL_SIZE))
+# Prepared statements cached per connection; set to 0 behind pgbouncer in transaction mode
+DB_STATEMENT_CACHE_SIZE = int(os.getenv("DB_STATEMENT_CACHE_SIZE", 100))
+# Statements running longer are cancelled by the server, 0 disables the limit
+DB_STATEMENT_TIMEOUT_MS = int(os.getenv("DB_STATEMENT_TIMEOUT_MS", 10_000))
 
 CHANNEL_ID = os.getenv("CHANNEL_ID")
 
 THROTTLE_TIME = int(os.getenv("THROTTLE_TIME"))
+# Suggestions a user can send at once before THROTTLE_TIME applies
+THROTTLE_BURST = int(os.getenv("THROTTLE_BURST", 1))
+# "memory" keeps limits per process, "postgres" shares them between all replicas
+THROTTLE_STORAGE = os.getenv("THROTTLE_STORAGE", "memory")
+
+# "postgres" keeps FSM states (e.g. caption editing) across restarts, "memory" loses them
+FSM_STORAGE = os.getenv("FSM_STORAGE", "postgres")
+FSM_CACHE_TTL = float(os.getenv("FSM_CACHE_TTL", 60))
+FSM_FLUSH_INTERVAL = float(os.getenv("FSM_FLUSH_INTERVAL", 0.5))  # seconds between batched writes
+
+# A suggestion with the same content as one the user sent within this window is rejected, 0 disables the check
+DUPLICATE_WINDOW_HOURS = float(os.getenv("DUPLICATE_WINDOW_HOURS", 24))
+
+# Banned users shown on one /banlist page
+BANLIST_PAGE_SIZE = int(os.getenv("BANLIST_PAGE_SIZE", 50))
+
+# In-process cache of users ban status used by ACLMiddleware
+USER_CACHE_SIZE = int(os.getenv("USER_CACHE_SIZE", 10_000))
+USER_CACHE_TTL = int(os.getenv("USER_CACHE_TTL", 3600))
+# Seconds to wait for LISTEN on startup; without it (e.g. pgbouncer in transaction mode) bans of other
+# processes only take effect when USER_CACHE_TTL expires
+BAN_LISTENER_TIMEOUT = float(os.getenv("BAN_LISTENER_TIMEOUT", 10))
 
 MESSAGE_LIFETIME_HOURS = int(os.getenv("MESSAGE_LIFETIME_HOURS"))
 MESSAGE_LIFETIME_SECONDS = int(os.getenv("MESSAGE_LIFETIME_SECONDS"))
+# How often expired suggestions are looked for and how many rows are removed per db round trip
+SWEEP_INTERVAL_SECONDS = int(os.getenv("SWEEP_INTERVAL_SECONDS", 60))
+SWEEP_BATCH_SIZE = int(os.getenv("SWEEP_BATCH_SIZE", 500))
+
+# Messages to moderators and to the channel are sent by the outbox worker, see scripts/outbox.py
+OUTBOX_BATCH_SIZE = int(os.getenv("OUTBOX_BATCH_SIZE", 50))  # messages taken per db round trip
+OUTBOX_CONCURRENCY = int(os.getenv("OUTBOX_CONCURRENCY", 10))
+OUTBOX_POLL_SECONDS = float(os.getenv("OUTBOX_POLL_SECONDS", 1))
+OUTBOX_MAX_ATTEMPTS = int(os.getenv("OUTBOX_MAX_ATTEMPTS", 5))
+# A message taken by a worker is retried by another one after this time, must exceed the time of its requests
+OUTBOX_LEASE_SECONDS = int(os.getenv("OUTBOX_LEASE_SECONDS", 120))
+
+# Outgoing requests limits (see https://core.telegram.org/bots/faq#my-bot-is-hitting-limits-how-do-i-avoid-this)
+TG_GLOBAL_RATE = float(os.getenv("TG_GLOBAL_RATE", 30))  # messages per second for the whole bot
+TG_CHAT_RATE = float(os.getenv("TG_CHAT_RATE", 1))  # messages per second in one chat
+TG_CHAT_BURST = float(os.getenv("TG_CHAT_BURST", 3))
+TG_MAX_RETRIES = int(os.getenv("TG_MAX_RETRIES", 3))
+# Custom Bot API server, e.g. scripts/fake_bot_api.py for local testing
+TELEGRAM_API_URL = os.getenv("TELEGRAM_API_URL")
+
+# Prometheus metrics; in webhook mode they are served by the webhook server at /metrics
+METRICS_ENABLED = os.getenv("METRICS_ENABLED", "true").lower() in ("1", "true", "yes")
+METRICS_HOST = os.getenv("METRICS_HOST", "0.0.0.0")
+METRICS_PORT = int(os.getenv("METRICS_PORT", 9090))
+
+# Updates delivery: long polling (default) or webhook
+USE_WEBHOOK = os.getenv("USE_WEBHOOK", "false").lower() in ("1", "true", "yes")
+# Public url Telegram sends updates to; if empty, the server only listens (e.g. for local testing)
+WEBHOOK_BASE_URL = os.getenv("WEBHOOK_BASE_URL")
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/webhook")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET")
+WEBAPP_HOST = os.getenv("WEBAPP_HOST", "0.0.0.0")
+WEBAPP_PORT = int(os.getenv("WEBAPP_PORT", 8080))
+# Max simultaneous connections Telegram opens to the webhook
+WEBHOOK_MAX_CONNECTIONS = int(os.getenv("WEBHOOK_MAX_CONNECTIONS", 40))
+# Max updates processed at the same time by one process
+MAX_UPDATES_IN_FLIGHT = int(os.getenv("MAX_UPDATES_IN_FLIGHT", 100))
+# Set to false to keep the updates received while the bot was down
+DROP_PENDING_UPDATES = os.getenv("DROP_PENDING_UPDATES", "true").lower() in ("1", "true", "yes")
+# Number of worker processes the updates are distributed to by chat id, 0 handles them in the receiving process
+WORKER_PROCESSES = int(os.getenv("WORKER_PROCESSES", 0))
+WORKER_QUEUE_SIZE = int(os.getenv("WORKER_QUEUE_SIZE", 1000))  # updates waiting for one worker
 
 TEXT_MESSAGES = {
     'start': 'Welcome to Suggestions Bot 👋 \n\nPlease, send your message and we will process your request.',
@@ -24,6 +106,8 @@ TEXT_MESSAGES = {
     'has_unbanned': '✅ User has been successfully un-banned!',
     'user_banned': '🚫 You cannot send messages to this bot!',
     'pending': 'Thank you for your suggestion! The admin received it',
+    'not_delivered': '❌ Your suggestion could not be delivered, please try again later',
+    'duplicate': '☝️ You have already sent this suggestion recently',
     'unsupported_format': '❌ Format of your message is not supported and it will not be forwarded.',
     'rm': '❌ Clear chat',
     'banlist': '👨‍🦽 Banlist',
@@ -34,14 +118,23 @@ TEXT_MESSAGES = {
     'no_args': '❌Error: argument was not passed',
     'failed_unban': '❌Error: Failed to unban the user',
     'list_of_banned': '👨‍🦽The list of banned users',
+    'banlist_page': '(page {0} of {1})',
     'to_unblock_enter': "To unblock a user, write the /unblock command to the bot and the user's ID.\n"
                         'For example: /unblock 123456789',
     'invalid_args': '❌Error: Invalid user ID format.',
     'failed_ban': '❌Ban failed',
     'edit_text': 'Please, enter the new caption',
     'album_limit': '❌You can send up to three photos',
+    'too_long': '❌ The text is too long: the limit is {0} characters, emoji and some other symbols count as two',
     'admin_start': 'Welcome, admin 👋',
     'posted': '✅Posted',
+    'not_ready': 'The suggestion is still being delivered, please try again in a few seconds',
+    'already_handled': '❌This suggestion has already been handled',
+    'in_progress': '⏳This suggestion is already being handled',
+    'try_again': '❌Something went wrong, please try again',
+    'already_posted': '✅This suggestion has already been posted',
+    'already_rejected': '🙅‍♂️This suggestion has already been rejected',
+    'clearing': '🧹 Clearing the chat: {0} suggestions deleted...',
     'cleared': '✅The chat has been cleared',
     'not_cleared': '❌The chat or db has not been cleared, please contact technical support',
     'throttling': '❌You can\'t send an offer yet, try again later\n(the delay from the previous suggestion is 5 minutes)',
@@ -0,0 +1,106 @@
+import asyncio
+import logging
+
+from cachetools import TTLCache
+from sqlalchemy.ext.asyncio import AsyncEngine
+
+from config import USER_CACHE_SIZE, USER_CACHE_TTL
+
+# Notified by orm_query in the transactions that ban or unban a user, the payload is "<user_id>:<0 or 1>"
+BAN_CHANNEL = 'user_bans'
+
+
+class UserCache:
+    """
+    Bounded LRU cache of user_id -> is_banned in front of the users table.
+    Changes made by this process are written to the cache immediately by orm_query, changes made by other
+    processes by BanListener. Entries expire after `ttl` seconds in any case.
+    """
+
+    def __init__(self, maxsize: int, ttl: int):
+        self.users = TTLCache(maxsize=maxsize, ttl=ttl)
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, user_id: int) -> bool | None:
+        """Returns the ban status of the user or None if the user is not cached"""
+        is_banned = self.users.get(user_id)
+        if is_banned is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return is_banned
+
+    def set(self, user_id: int, is_banned: bool):
+        self.users[user_id] = is_banned
+
+    def clear(self):
+        self.users.clear()
+
+    def warm(self, users: list[tuple[int, bool]]):
+        for user_id, is_banned in users:
+            self.set(user_id, is_banned)
+
+    @property
+    def hit_rate(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    def stats(self) -> dict:
+        return {
+            "size": len(self.users),
+            "maxsize": self.users.maxsize,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hit_rate, 4),
+        }
+
+
+class BanListener:
+    """
+    Listens to BAN_CHANNEL on a connection of its own, so a ban made in one bot process (e.g. the worker
+    of the moderator chat) takes effect in all of them at once.
+    Notifications sent while the connection is down are lost, the cache is cleared when it is back.
+    """
+
+    def __init__(self, engine: AsyncEngine, cache: UserCache, check_interval: float = 5):
+        self.engine = engine
+        self.cache = cache
+        self.check_interval = check_interval
+        self.listening = asyncio.Event()
+        self.task: asyncio.Task | None = None
+
+    def start(self):
+        self.task = asyncio.create_task(self.run())
+
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            await asyncio.gather(self.task, return_exceptions=True)
+
+    def on_notification(self, connection, pid: int, channel: str, payload: str):
+        user_id, is_banned = payload.split(':')
+        self.cache.set(int(user_id), is_banned == '1')
+
+    async def run(self):
+        reconnect = False
+        while True:
+            try:
+                async with self.engine.connect() as conn:
+                    connection = (await conn.get_raw_connection()).driver_connection
+                    await connection.add_listener(BAN_CHANNEL, self.on_notification)
+                    if reconnect:
+                        self.cache.clear()
+                    self.listening.set()
+                    while not connection.is_closed():
+                        await asyncio.sleep(self.check_interval)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logging.error(f'Ban listener failed: {e!r}, reconnecting in {self.check_interval}s')
+            self.listening.clear()
+            reconnect = True
+            await asyncio.sleep(self.check_interval)
+
+
+user_cache = UserCache(maxsize=USER_CACHE_SIZE, ttl=USER_CACHE_TTL)
@@ -1,19 +1,177 @@
-from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker, create_async_engine
+import asyncio
+import logging
+import time
+from dataclasses import dataclass
 
-from database.models import Base
-from config import DATABASE_URL
+from sqlalchemy import inspect, text
+from sqlalchemy.ext.asyncio import AsyncEngine, AsyncSession, async_sessionmaker, create_async_engine
+from sqlalchemy.pool import AsyncAdaptedQueuePool
 
+from database.models import Base, Suggestion
+from config import MODERATOR_IDS, DATABASE_URL, DB_ECHO, DB_POOL_SIZE, DB_MAX_OVERFLOW, DB_POOL_TIMEOUT, DB_POOL_PRE_PING, \
+    DB_POOL_RECYCLE, DB_POOL_PREWARM, DB_STATEMENT_CACHE_SIZE, DB_STATEMENT_TIMEOUT_MS
+from metrics import DB_POOL_CHECKED_OUT, DB_POOL_OVERFLOW, DB_POOL_WAIT_SECONDS
 
-engine = create_async_engine(DATABASE_URL, echo=True)
+
+@dataclass(frozen=True)
+class EngineSettings:
+    url: str
+    echo: bool = False
+    pool_size: int = 10
+    max_overflow: int = 10
+    pool_timeout: float = 30
+    pool_pre_ping: bool = True
+    pool_recycle: int = 1800
+    prewarm: int = 10
+    statement_cache_size: int = 100
+    statement_timeout_ms: int = 10_000
+
+    @classmethod
+    def from_config(cls) -> 'EngineSettings':
+        return cls(url=DATABASE_URL,
+                   echo=DB_ECHO,
+                   pool_size=DB_POOL_SIZE,
+                   max_overflow=DB_MAX_OVERFLOW,
+                   pool_timeout=DB_POOL_TIMEOUT,
+                   pool_pre_ping=DB_POOL_PRE_PING,
+                   pool_recycle=DB_POOL_RECYCLE,
+                   prewarm=min(DB_POOL_PREWARM, DB_POOL_SIZE),
+                   statement_cache_size=DB_STATEMENT_CACHE_SIZE,
+                   statement_timeout_ms=DB_STATEMENT_TIMEOUT_MS)
+
+
+class TimedQueuePool(AsyncAdaptedQueuePool):
+    """Observes how long checkouts wait for a connection in DB_POOL_WAIT_SECONDS"""
+
+    def _do_get(self):
+        started = time.perf_counter()
+        try:
+            return super()._do_get()
+        finally:
+            DB_POOL_WAIT_SECONDS.observe(time.perf_counter() - started)
+
+
+def create_engine(settings: EngineSettings) -> AsyncEngine:
+    server_settings = {}
+    if settings.statement_timeout_ms:
+        server_settings['statement_timeout'] = str(settings.statement_timeout_ms)
+
+    return create_async_engine(
+        settings.url,
+        echo=settings.echo,
+        poolclass=TimedQueuePool,
+        pool_size=settings.pool_size,
+        max_overflow=settings.max_overflow,
+        pool_timeout=settings.pool_timeout,
+        pool_pre_ping=settings.pool_pre_ping,
+        pool_recycle=settings.pool_recycle,
+        connect_args={
+            # The first one is the cache of SQLAlchemy's asyncpg adapter, the second one of asyncpg itself.
+            # Both must be 0 when connections go through pgbouncer in transaction mode
+            'prepared_statement_cache_size': settings.statement_cache_size,
+            'statement_cache_size': settings.statement_cache_size,
+            'server_settings': server_settings,
+        },
+    )
+
+
+engine_settings = EngineSettings.from_config()
+engine = create_engine(engine_settings)
+
+DB_POOL_CHECKED_OUT.set_function(lambda: engine.pool.checkedout())
+DB_POOL_OVERFLOW.set_function(lambda: max(engine.pool.overflow(), 0))
 
 session_maker = async_sessionmaker(bind=engine, class_=AsyncSession, autoflush=False, expire_on_commit=False)
 
 
+# create_all() only creates missing tables, these statements bring tables created by older versions up to date.
+# Every statement must be safe to run on each start; they are executed with upgrade_parameters().
+SCHEMA_UPGRADES = [
+    # suggestion_id used to be calculated as MAX(suggestion_id) + 1
+    "CREATE SEQUENCE IF NOT EXISTS suggestion_id_seq",
+    "SELECT setval('suggestion_id_seq', max(suggestion_id)) FROM suggestions "
+    "HAVING max(suggestion_id) >= (SELECT last_value FROM suggestion_id_seq)",
+    # Suggestions used to go to the admin chat only
+    "ALTER TABLE suggestions ADD COLUMN IF NOT EXISTS moderator_id BIGINT",
+    "UPDATE suggestions SET moderator_id = :first_moderator_id WHERE moderator_id IS NULL",
+    "ALTER TABLE suggestions ALTER COLUMN moderator_id SET NOT NULL",
+    # Suggestions used to be deleted when they were posted or rejected
+    "ALTER TABLE suggestions ADD COLUMN IF NOT EXISTS status VARCHAR(16) NOT NULL DEFAULT 'pending'",
+    # Posts are copied from the moderator chat, the content was never read back
+    "ALTER TABLE suggestions DROP COLUMN IF EXISTS file_ids, DROP COLUMN IF EXISTS caption, "
+    "DROP COLUMN IF EXISTS entities",
+    # No query looks suggestions up by user, the index only slowed down the inserts
+    "DROP INDEX IF EXISTS ix_suggestions_user_id",
+]
+
+# Suggestions used to take a row per album photo, with the caption on the first one
+MERGE_SUGGESTION_ROWS = """
+INSERT INTO suggestions (suggestion_id, kind, user_id, moderator_id, mess_ids, help_message, created, updated)
+SELECT suggestion_id,
+       CASE WHEN count(*) > 1 THEN 'album' END,
+       min(user_id),
+       min(moderator_id),
+       CASE WHEN bool_and(mess_id IS NOT NULL) THEN array_agg(mess_id ORDER BY id) END,
+       max(help_message),
+       min(created),
+       max(updated)
+FROM suggestion_rows
+GROUP BY suggestion_id
+"""
+
+
+def upgrade_parameters() -> dict:
+    # The admin chat is the first moderator chat unless MODERATOR_IDS is set
+    return {'first_moderator_id': MODERATOR_IDS[0] if MODERATOR_IDS else None}
+
+
+def merge_suggestion_rows(connection):
+    """Moves suggestions of the row-per-photo layout to the one-row layout, does nothing on later starts"""
+    columns = {column['name'] for column in inspect(connection).get_columns('suggestions')}
+    if 'file_id' not in columns:
+        return
+
+    # The old table keeps its constraint and index names, they must be free for the new one
+    connection.execute(text("ALTER TABLE suggestions RENAME TO suggestion_rows"))
+    connection.execute(text("ALTER TABLE suggestion_rows RENAME CONSTRAINT suggestions_pkey TO suggestion_rows_pkey"))
+    for index in inspect(connection).get_indexes('suggestion_rows'):
+        connection.execute(text(f'DROP INDEX "{index["name"]}"'))
+
+    # suggestion_id_seq already exists, create_all() and the upgrades made it
+    Suggestion.__table__.create(connection, checkfirst=True)
+    result = connection.execute(text(MERGE_SUGGESTION_ROWS))
+    connection.execute(text("DROP TABLE suggestion_rows"))
+    logging.info(f"{result.rowcount} suggestions have been moved to the one-row layout")
+
+
+def create_missing_indexes(connection):
+    """create_all() skips indexes of existing tables, so they are created separately"""
+    for table in Base.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(connection, checkfirst=True)
+
+
 async def create_db():
     async with engine.begin() as conn:
+        # Creating indexes on big tables may take longer than the statement timeout of the bot queries
+        await conn.execute(text("SET LOCAL statement_timeout = 0"))
         await conn.run_sync(Base.metadata.create_all)
+        parameters = upgrade_parameters()
+        for statement in SCHEMA_UPGRADES:
+            await conn.execute(text(statement), parameters)
+        await conn.run_sync(merge_suggestion_rows)
+        # After the upgrades, indexes may use the columns they add
+        await conn.run_sync(create_missing_indexes)
 
 
 async def drop_db():
     async with engine.begin() as conn:
-        await conn.run_sync(Base.metadata.drop_all)
\ No newline at end of file
+        await conn.run_sync(Base.metadata.drop_all)
+
+
+async def prewarm_pool(size: int = engine_settings.prewarm):
+    """Opens `size` connections at once and returns them to the pool, so the first updates don't wait for them"""
+    if size <= 0:
+        return
+    connections = await asyncio.gather(*(engine.connect().start() for _ in range(size)))
+    await asyncio.gather(*(connection.close() for connection in connections))
@@ -0,0 +1,138 @@
+import asyncio
+import logging
+from typing import Any, Dict, Optional
+
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import BaseStorage, DefaultKeyBuilder, KeyBuilder, StateType, StorageKey
+from cachetools import LRUCache, TTLCache
+from sqlalchemy.ext.asyncio import async_sessionmaker
+
+from database.orm_query import orm_get_fsm_records, orm_save_fsm_records
+
+# (state, data) of a key that is not stored
+EMPTY_RECORD = (None, {})
+
+
+class PostgresStorage(BaseStorage):
+    """
+    FSM storage in the fsm_states table: states survive restarts.
+
+    Records are read through a local TTL cache, cache misses of concurrent updates are loaded with one SELECT.
+    Keys that are not stored (most users never have a state) are remembered without expiry in a bounded LRU,
+    so the get_state() aiogram makes for every update doesn't query the table again and again. This relies on
+    the updates of a chat being handled by one process (see scripts/worker_pool.py): every write of a key goes
+    through the process that cached it.
+    Writes go to the cache at once and are flushed to the table in batches every `flush_interval` seconds
+    and on close, so a crash loses at most the changes of the last `flush_interval`.
+    """
+
+    def __init__(self, session_pool: async_sessionmaker, key_builder: Optional[KeyBuilder] = None,
+                 cache_size: int = 10_000, cache_ttl: float = 60, flush_interval: float = 0.5):
+        self.session_pool = session_pool
+        self.key_builder = key_builder or DefaultKeyBuilder(with_destiny=True)
+        self.cache = TTLCache(maxsize=cache_size, ttl=cache_ttl)
+        self.absent = LRUCache(maxsize=cache_size)  # keys known not to be stored
+        self.flush_interval = flush_interval
+
+        self.dirty: dict[str, tuple] = {}  # changed records waiting for the next flush
+        self.flushing: dict[str, tuple] = {}  # records being written right now
+        self.pending_reads: dict[str, asyncio.Future] = {}
+        self.load_task: asyncio.Task | None = None
+        self.flush_task: asyncio.Task | None = None
+
+    async def get_record(self, key: StorageKey) -> tuple:
+        storage_key = self.key_builder.build(key)
+        for records in (self.dirty, self.flushing, self.cache):
+            record = records.get(storage_key)
+            if record is not None:
+                return record
+        if storage_key in self.absent:
+            return EMPTY_RECORD
+
+        future = self.pending_reads.get(storage_key)
+        if future is None:
+            future = self.pending_reads[storage_key] = asyncio.get_running_loop().create_future()
+            if self.load_task is None or self.load_task.done():
+                self.load_task = asyncio.create_task(self.load_pending())
+        return await future
+
+    async def load_pending(self):
+        # Let the reads of the concurrently processed updates join the batch
+        await asyncio.sleep(0)
+        # Misses that come while a batch is loading don't start a task, they make the next batch
+        while self.pending_reads:
+            pending, self.pending_reads = self.pending_reads, {}
+            try:
+                async with self.session_pool() as session:
+                    records = await orm_get_fsm_records(session, list(pending))
+            except Exception as e:
+                for future in pending.values():
+                    future.set_exception(e)
+                continue
+
+            for storage_key, future in pending.items():
+                # A write made while the batch was loading is newer than the row
+                record = self.dirty.get(storage_key) or self.flushing.get(storage_key) or records.get(storage_key)
+                if record is None:
+                    self.absent[storage_key] = True
+                    record = EMPTY_RECORD
+                else:
+                    self.cache[storage_key] = record
+                future.set_result(record)
+
+    def put_record(self, key: StorageKey, record: tuple):
+        storage_key = self.key_builder.build(key)
+        # state.clear() of a context without state and data changes nothing
+        cached = EMPTY_RECORD if storage_key in self.absent else self.cache.get(storage_key)
+        if cached == record:
+            return
+        self.absent.pop(storage_key, None)
+        self.cache[storage_key] = record
+        self.dirty[storage_key] = record
+        if self.flush_task is None or self.flush_task.done():
+            self.flush_task = asyncio.create_task(self.flush_later())
+
+    async def flush_later(self):
+        while self.dirty:
+            await asyncio.sleep(self.flush_interval)
+            await self.flush()
+
+    async def flush(self):
+        if not self.dirty:
+            return
+
+        self.flushing, self.dirty = self.dirty, {}
+        try:
+            async with self.session_pool() as session:
+                await orm_save_fsm_records(session, self.flushing)
+            self.flushing = {}
+        except Exception as e:
+            logging.exception(f"Failed to save {len(self.flushing)} FSM records, retrying with the next flush",
+                              exc_info=e)
+        finally:
+            # Records that were not saved (error or cancellation) go back, changes made during the flush are newer
+            if self.flushing:
+                self.dirty = {**self.flushing, **self.dirty}
+                self.flushing = {}
+
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        _, data = await self.get_record(key)
+        self.put_record(key, (state.state if isinstance(state, State) else state, data))
+
+    async def get_state(self, key: StorageKey) -> Optional[str]:
+        state, _ = await self.get_record(key)
+        return state
+
+    async def set_data(self, key: StorageKey, data: Dict[str, Any]) -> None:
+        state, _ = await self.get_record(key)
+        self.put_record(key, (state, data.copy()))
+
+    async def get_data(self, key: StorageKey) -> Dict[str, Any]:
+        _, data = await self.get_record(key)
+        return data.copy()
+
+    async def close(self) -> None:
+        if self.flush_task is not None:
+            self.flush_task.cancel()
+            await asyncio.gather(self.flush_task, return_exceptions=True)
+        await self.flush()
@@ -1,7 +1,7 @@
-from aiogram.types import MessageEntity
-from sqlalchemy import BigInteger, DateTime, func, Integer, String
-from sqlalchemy.dialects.postgresql import JSONB
-from sqlalchemy.ext.mutable import MutableList
+from enum import StrEnum
+
+from sqlalchemy import BigInteger, DateTime, Float, func, Index, Integer, Sequence, String, text
+from sqlalchemy.dialects.postgresql import ARRAY, JSONB
 from sqlalchemy.orm import DeclarativeBase, Mapped, mapped_column
 
 
@@ -12,20 +12,98 @@ class Base(DeclarativeBase):
 
 class User(Base):
     __tablename__ = 'users'
+    __table_args__ = (
+        # Only banned users get into the index, it stays small and serves the banlist
+        Index('ix_users_banned_user_id', 'user_id', postgresql_where=text('is_banned')),
+    )
     id: Mapped[int] = mapped_column(primary_key=True, autoincrement=True)
     user_id: Mapped[int] = mapped_column(BigInteger, unique=True, nullable=False)
     is_banned: Mapped[bool] = mapped_column(default=False, nullable=False)
 
 
+# Suggestion ids are handed out by the database, so concurrent submissions never share an id
+suggestion_id_seq = Sequence('suggestion_id_seq')
+
+
+class SuggestionKind(StrEnum):
+    TEXT = 'text'
+    PHOTO = 'photo'
+    ALBUM = 'album'
+
+
+class SuggestionStatus(StrEnum):
+    PENDING = 'pending'
+    POSTING = 'posting'  # claimed by a post, the outbox is copying it to the channel
+    POSTED = 'posted'
+    REJECTED = 'rejected'
+
+
 class Suggestion(Base):
+    """
+    One row per suggestion, an album included: post, reject, edit and ban look it up by the primary key.
+    `mess_ids` are in the order of the photos; the content itself is only kept in the moderator chat.
+    Posted and rejected suggestions keep their row until they expire, so a repeated post or reject
+    can be answered with what happened to the suggestion
+    """
     __tablename__ = 'suggestions'
-    id: Mapped[int] = mapped_column(primary_key=True, autoincrement=True)
+    __table_args__ = (
+        # Pending load of moderators
+        Index('ix_suggestions_moderator_id', 'moderator_id'),
+        # Expiry sweeper
+        Index('ix_suggestions_created', 'created'),
+    )
+    suggestion_id: Mapped[int] = mapped_column(Integer, suggestion_id_seq, primary_key=True)
+    # NULL for suggestions moved from the row-per-photo layout, it didn't tell texts from photos
+    kind: Mapped[str] = mapped_column(String(16), nullable=True)
+    status: Mapped[str] = mapped_column(String(16), nullable=False, server_default=SuggestionStatus.PENDING.value)
     user_id: Mapped[int] = mapped_column(BigInteger, nullable=False)
-    mess_id: Mapped[int] = mapped_column(BigInteger, nullable=False)
-    suggestion_id: Mapped[int] = mapped_column(Integer, nullable=False)
-    file_id: Mapped[str] = mapped_column(String(150), nullable=True)
-    caption: Mapped[str] = mapped_column(String(4096), nullable=True)  # 4096 chars for tg premium
+    moderator_id: Mapped[int] = mapped_column(BigInteger, nullable=False)  # the chat the suggestion was sent to
+    # Messages in the moderator chat, set when the outbox has sent them
+    mess_ids: Mapped[list[int]] = mapped_column(ARRAY(BigInteger), nullable=True)
     help_message: Mapped[int] = mapped_column(BigInteger, nullable=True)
-    entities: Mapped[MutableList[MessageEntity]] = mapped_column(JSONB, nullable=True)
 
 
+class SuggestionFingerprint(Base):
+    """
+    Content fingerprint of a suggestion sent by the user; `created` is the time it was last accepted.
+    Kept apart from suggestions, whose rows are deleted when the suggestion is posted, rejected or expires
+    """
+    __tablename__ = 'suggestion_fingerprints'
+    __table_args__ = (
+        # Cleanup of fingerprints older than the duplicate window
+        Index('ix_suggestion_fingerprints_created', 'created'),
+    )
+    user_id: Mapped[int] = mapped_column(BigInteger, primary_key=True)
+    fingerprint: Mapped[str] = mapped_column(String(32), primary_key=True)
+
+
+class ThrottleBucket(Base):
+    """Token bucket of a chat for a throttling key; `updated` is the time tokens were last counted"""
+    __tablename__ = 'throttle_buckets'
+    key: Mapped[str] = mapped_column(String(64), primary_key=True)
+    chat_id: Mapped[int] = mapped_column(BigInteger, primary_key=True)
+    tokens: Mapped[float] = mapped_column(Float, nullable=False)
+
+
+class FSMRecord(Base):
+    """State and data of an aiogram FSM context, `key` is built by the key builder of PostgresStorage"""
+    __tablename__ = 'fsm_states'
+    key: Mapped[str] = mapped_column(String(255), primary_key=True)
+    state: Mapped[str] = mapped_column(String(255), nullable=True)
+    data: Mapped[dict] = mapped_column(JSONB, nullable=False)
+
+
+class OutboxMessage(Base):
+    """Bot API requests saved together with the change they belong to and made after its commit, see scripts/outbox.py"""
+    __tablename__ = 'outbox'
+    __table_args__ = (
+        Index('ix_outbox_available_at', 'available_at'),
+    )
+    id: Mapped[int] = mapped_column(primary_key=True, autoincrement=True)
+    kind: Mapped[str] = mapped_column(String(32), nullable=False)
+    suggestion_id: Mapped[int] = mapped_column(Integer, nullable=False)
+    requests: Mapped[list] = mapped_column(JSONB, nullable=False)  # [{"method": "SendMessage", "params": {...}}]
+    results: Mapped[list] = mapped_column(JSONB, nullable=False)  # message ids returned by the requests made so far
+    attempts: Mapped[int] = mapped_column(Integer, default=0, nullable=False)
+    available_at: Mapped[DateTime] = mapped_column(DateTime, default=func.now(), nullable=False)
+    last_error: Mapped[str] = mapped_column(String(1024), nullable=True)
@@ -1,114 +1,211 @@
 import logging
 import json
+from datetime import timedelta
 
-from aiogram.types import MessageEntity
-from sqlalchemy import select, func, update, delete
+from sqlalchemy import BigInteger, case, column, select, func, update, delete, tuple_, values
+from sqlalchemy.dialects.postgresql import insert as pg_insert
 from sqlalchemy.ext.asyncio import AsyncSession
 
-from database.models import User, Suggestion
-
-
-def serialize_entities(entities: list[MessageEntity]) -> list[dict]:
-    return [
-        {
-            "type": entity.type,
-            "offset": entity.offset,
-            "length": entity.length,
-            "url": entity.url,
-            "user": entity.user.id if entity.user else None,
-            "language": entity.language,
-            "custom_emoji_id": entity.custom_emoji_id,
-        }
-        for entity in entities
-    ]
-
-
-def deserialize_entities(entities_data: list[dict]) -> list[MessageEntity]:
-    return [
-        MessageEntity(
-            type=entity["type"],
-            offset=entity["offset"],
-            length=entity["length"],
-            url=entity.get("url"),
-            user=entity.get("user"),
-            language=entity.get("language"),
-            custom_emoji_id=entity.get("custom_emoji_id"),
-        )
-        for entity in entities_data
-    ]
-
-
-async def orm_add_user(session: AsyncSession, user_id: int):
-    user = User(
-        user_id=user_id
-    )
-
-    session.add(user)
+from database.cache import BAN_CHANNEL, user_cache
+from metrics import track_query
+from database.models import User, Suggestion, SuggestionFingerprint, SuggestionKind, SuggestionStatus, ThrottleBucket, \
+    FSMRecord, OutboxMessage, suggestion_id_seq
+
+# Messages of posted and rejected suggestions are already deleted from the moderator chat
+IN_CHAT = Suggestion.status.in_((SuggestionStatus.PENDING, SuggestionStatus.POSTING))
+CHAT_MESS_IDS = case((IN_CHAT, Suggestion.mess_ids))
+CHAT_HELP_MESSAGE = case((IN_CHAT, Suggestion.help_message))
+
+
+@track_query
+async def orm_add_user(session: AsyncSession, user_id: int) -> bool:
+    """Registers the user if it is unknown. Returns the ban status of the user"""
+    # The update on conflict makes RETURNING give the status of an existing user in the same statement,
+    # `updated` marks the user active for orm_get_recent_users
+    query = (pg_insert(User)
+             .values(user_id=user_id)
+             .on_conflict_do_update(index_elements=[User.user_id],
+                                    set_={'is_banned': User.is_banned, 'updated': func.now()})
+             .returning(User.is_banned))
+    result = await session.execute(query)
+    is_banned = result.scalar_one()
     await session.commit()
 
+    user_cache.set(user_id, is_banned)
+    return is_banned
+
 
+@track_query
 async def orm_get_user(session: AsyncSession, user_id: int):
     query = select(User).where(User.user_id == user_id)
     result = await session.execute(query)
     return result.scalar()
 
 
-async def get_next_suggestion_id(session: AsyncSession) -> int:
-    result = await session.execute(select(func.max(Suggestion.suggestion_id)))
-    max_suggestion_id = result.scalar_one_or_none()
-    return (max_suggestion_id or 0) + 1
+@track_query
+async def orm_get_recent_users(session: AsyncSession, limit: int) -> list[tuple[int, bool]]:
+    """Returns (user_id, is_banned) of the most recently updated users, used to warm the user cache"""
+    query = select(User.user_id, User.is_banned).order_by(User.updated.desc()).limit(limit)
+    result = await session.execute(query)
+    return result.all()
+
+
+@track_query
+async def orm_next_suggestion_id(session: AsyncSession) -> int:
+    """Takes the next id from the sequence; ids are unique even for concurrent submissions"""
+    result = await session.execute(select(suggestion_id_seq.next_value()))
+    return result.scalar_one()
+
+
+@track_query
+async def orm_next_suggestion_id_and_moderator(session: AsyncSession, moderator_ids: list[int]) -> tuple[int, int]:
+    """
+    Takes the next suggestion id and picks the moderator with the fewest pending suggestions in one round trip.
+    Moderators with the same load are picked randomly, so concurrent submissions spread between them.
+    """
+    moderators = values(column('moderator_id', BigInteger), name='moderators').data([(m,) for m in moderator_ids])
+    least_loaded = (select(moderators.c.moderator_id)
+                    .select_from(moderators)
+                    .outerjoin(Suggestion, (Suggestion.moderator_id == moderators.c.moderator_id)
+                               & (Suggestion.status == SuggestionStatus.PENDING))
+                    .group_by(moderators.c.moderator_id)
+                    .order_by(func.count(Suggestion.suggestion_id), func.random())
+                    .limit(1)
+                    .scalar_subquery())
+    result = await session.execute(select(suggestion_id_seq.next_value(), least_loaded))
+    suggestion_id, moderator_id = result.one()
+    return suggestion_id, moderator_id
+
+
+@track_query
+async def orm_remember_fingerprint(session: AsyncSession, user_id: int, fingerprint: str, window: timedelta) -> bool:
+    """
+    Records the fingerprint of a new suggestion of the user in one atomic statement.
+    Returns False if the user sent the same content within `window`, the fingerprint is not updated then.
+    Doesn't commit, the fingerprint is saved together with the suggestion
+    """
+    query = (pg_insert(SuggestionFingerprint)
+             .values(user_id=user_id, fingerprint=fingerprint)
+             .on_conflict_do_update(index_elements=[SuggestionFingerprint.user_id, SuggestionFingerprint.fingerprint],
+                                    set_={'created': func.now(), 'updated': func.now()},
+                                    where=SuggestionFingerprint.created < func.now() - window)
+             .returning(SuggestionFingerprint.user_id))
+    result = await session.execute(query)
+    return result.first() is not None
 
 
-async def orm_add_new_suggestion(session: AsyncSession, user_id: int, new_mess_id: int):
-    next_suggestion_id = await get_next_suggestion_id(session)
+@track_query
+async def orm_delete_old_fingerprints(session: AsyncSession, window: timedelta, limit: int) -> int:
+    """Deletes up to `limit` fingerprints older than `window`, returns the number of deleted rows"""
+    old = (select(SuggestionFingerprint.user_id, SuggestionFingerprint.fingerprint)
+           .where(SuggestionFingerprint.created < func.now() - window)
+           .limit(limit)
+           .with_for_update(skip_locked=True))
 
-    suggestion = Suggestion(user_id=user_id,
-                            mess_id=new_mess_id,
-                            suggestion_id=next_suggestion_id)
-    session.add(suggestion)
+    query = (delete(SuggestionFingerprint)
+             .where(tuple_(SuggestionFingerprint.user_id, SuggestionFingerprint.fingerprint).in_(old))
+             .execution_options(synchronize_session=False))
+    result = await session.execute(query)
     await session.commit()
-    return next_suggestion_id
-
-
-async def orm_add_new_suggestions(session: AsyncSession, user_id: int, file_ids_with_mess_ids: dict[int, str],
-                                  caption: str, entities: list[MessageEntity]):
-    next_suggestion_id = await get_next_suggestion_id(session)
-    serialized_entities = serialize_entities(entities)
-
-    suggestions = [
-        Suggestion(user_id=user_id,
-                   mess_id=new_mess_id,
-                   suggestion_id=next_suggestion_id,
-                   file_id=file_id
-                   )
-        for new_mess_id, file_id in file_ids_with_mess_ids
-    ]
-    suggestions[0].caption = caption  # set caption only for first record in db
-    suggestions[0].entities = serialized_entities
-
-    session.add_all(suggestions)
+
+    return result.rowcount
+
+
+@track_query
+async def orm_add_new_suggestion(session: AsyncSession, user_id: int, moderator_id: int, suggestion_id: int,
+                                 kind: SuggestionKind):
+    suggestion = Suggestion(suggestion_id=suggestion_id,
+                            kind=kind,
+                            user_id=user_id,
+                            moderator_id=moderator_id)
+    session.add(suggestion)
     await session.commit()
-    return next_suggestion_id
 
 
-async def orm_get_and_delete_all_suggestions(session: AsyncSession) -> list[Suggestion]:
-    query = select(Suggestion)
+@track_query
+async def orm_delete_moderator_suggestions(session: AsyncSession, moderator_id: int, limit: int) -> list[tuple]:
+    """
+    Deletes up to `limit` suggestions sent to the moderator, oldest first.
+    Returns (mess_ids, help_message) of deleted rows, both None if the messages are no longer in the chat
+    """
+    batch = (select(Suggestion.suggestion_id)
+             .where(Suggestion.moderator_id == moderator_id)
+             .order_by(Suggestion.suggestion_id)
+             .limit(limit)
+             .with_for_update(skip_locked=True)
+             .scalar_subquery())
+
+    query = (delete(Suggestion)
+             .where(Suggestion.suggestion_id.in_(batch))
+             .returning(CHAT_MESS_IDS, CHAT_HELP_MESSAGE)
+             .execution_options(synchronize_session=False))
     result = await session.execute(query)
-    suggestions = result.scalars().all()
+    rows = result.all()
+    await session.commit()
 
-    delete_query = delete(Suggestion)
-    await session.execute(delete_query)
+    return rows
+
+
+@track_query
+async def orm_delete_expired_suggestions(session: AsyncSession, lifetime: timedelta, limit: int) -> list[tuple]:
+    """
+    Deletes up to `limit` suggestions older than `lifetime`.
+    Returns (moderator_id, mess_ids, help_message) of deleted rows, mess_ids and help_message are None
+    if the messages are no longer in the chat
+    """
+    expired = (select(Suggestion.suggestion_id)
+               .where(Suggestion.created < func.now() - lifetime)
+               .order_by(Suggestion.suggestion_id)
+               .limit(limit)
+               .with_for_update(skip_locked=True)
+               .scalar_subquery())
+
+    query = (delete(Suggestion)
+             .where(Suggestion.suggestion_id.in_(expired))
+             .returning(Suggestion.moderator_id, CHAT_MESS_IDS, CHAT_HELP_MESSAGE)
+             .execution_options(synchronize_session=False))
+    result = await session.execute(query)
+    rows = result.all()
     await session.commit()
 
-    return suggestions
+    return rows
 
 
-async def orm_get_banned_users(session: AsyncSession):
-    query = select(User).where(User.is_banned == True)
-    result = await session.execute(query)
-    return result.scalars().all()
+@track_query
+async def orm_get_banned_users_page(session: AsyncSession, limit: int, after: int | None = None,
+                                    before: int | None = None) -> list[int]:
+    """
+    Keyset pagination over banned user ids in ascending order: up to `limit` ids greater than `after`
+    or, if `before` is given, the last `limit` ids less than `before`.
+    Served by the partial index ix_users_banned_user_id, so the cost doesn't depend on the page number.
+    """
+    query = select(User.user_id).where(User.is_banned == True)
+    if before is not None:
+        query = query.where(User.user_id < before).order_by(User.user_id.desc())
+    else:
+        if after is not None:
+            query = query.where(User.user_id > after)
+        query = query.order_by(User.user_id)
 
+    result = await session.execute(query.limit(limit))
+    user_ids = result.scalars().all()
+    return sorted(user_ids)
 
+
+@track_query
+async def orm_count_banned_users(session: AsyncSession, limit: int) -> int:
+    """Counts banned users, but not more than `limit`, so the count costs the same for any banlist size"""
+    banned = select(User.user_id).where(User.is_banned == True).limit(limit).subquery()
+    result = await session.execute(select(func.count()).select_from(banned))
+    return result.scalar_one()
+
+
+async def notify_ban_change(session: AsyncSession, user_id: int, is_banned: bool):
+    """The other processes update their user caches when the transaction commits, see database/cache.py"""
+    await session.execute(select(func.pg_notify(BAN_CHANNEL, f'{user_id}:{int(is_banned)}')))
+
+
+@track_query
 async def orm_block_user_by_sug_id(session: AsyncSession, suggestion_id: int):
     query = select(Suggestion).where(Suggestion.suggestion_id == suggestion_id)
     result = await session.execute(query)
@@ -122,106 +219,257 @@ async def orm_block_user_by_sug_id(session: AsyncSession, suggestion_id: int):
     query = update(User).where(User.user_id == user_id_to_ban, User.is_banned == False).values(
         is_banned=True)
     result = await session.execute(query)
+    if result.rowcount:
+        await notify_ban_change(session, user_id_to_ban, True)
     await session.commit()
 
     if result.rowcount == 0:
         return False
 
+    user_cache.set(user_id_to_ban, True)
     return True
 
 
+@track_query
 async def orm_unblock_user(session: AsyncSession, user_id: int) -> bool:
     query = update(User).where(User.user_id == user_id, User.is_banned == True).values(
         is_banned=False)  #.execution_options(synchronize_session="fetch")
 
     result = await session.execute(query)
+    if result.rowcount:
+        await notify_ban_change(session, user_id, False)
     await session.commit()
 
     if result.rowcount == 0:
         return False
 
+    user_cache.set(user_id, False)
     return True
 
 
-async def orm_extract_suggestions(session: AsyncSession, suggestion_id: int):
+@track_query
+async def orm_claim_suggestion(session: AsyncSession, suggestion_id: int, status: SuggestionStatus,
+                               commit: bool = True) -> Suggestion | None:
+    """
+    Claims a pending suggestion: moves it to `status` and returns it in one statement.
+    A concurrent claim waits for the row lock and, once the first one commits, finds the suggestion
+    no longer pending: only one moderator action gets it, the others get None (see orm_get_suggestion_status).
+    With commit=False the caller commits, e.g. together with the outbox message that posts the suggestion.
+    """
     try:
-        # Checking the availability of a suggestion
-        query = select(Suggestion).where(Suggestion.suggestion_id == suggestion_id)
+        query = (update(Suggestion)
+                 .where(Suggestion.suggestion_id == suggestion_id, Suggestion.status == SuggestionStatus.PENDING)
+                 .values(status=status)
+                 .returning(Suggestion)
+                 .execution_options(synchronize_session=False))
         result = await session.execute(query)
-        suggestions = result.scalars().all()
-
-        if not suggestions:
-            return None
-
-        # Deleting the suggestion
-        delete_query = delete(Suggestion).where(Suggestion.suggestion_id == suggestion_id)
-        await session.execute(delete_query)
-        await session.commit()
-
-        # Deserializing entities
-        if suggestions[0].entities:
-            suggestions[0].entities = deserialize_entities(suggestions[0].entities)
+        suggestion = result.scalar_one_or_none()
+        if commit:
+            await session.commit()
 
-        return suggestions
+        return suggestion
 
     except Exception as e:
         logging.exception(f"An error occurred", exc_info=e)
+        # The failed transaction would reject the status query of the caller
+        await session.rollback()
         return None
 
 
-async def orm_get_suggestions(session: AsyncSession, suggestion_id: int) -> list[Suggestion]:
-    try:
-        # Checking the availability of a suggestion
-        query = select(Suggestion).where(Suggestion.suggestion_id == suggestion_id)
-        result = await session.execute(query)
-        suggestions = result.scalars().all()
+@track_query
+async def orm_get_suggestion_status(session: AsyncSession, suggestion_id: int) -> SuggestionStatus | None:
+    """None if there is no such suggestion (it expired or the chat was cleared)"""
+    result = await session.execute(select(Suggestion.status).where(Suggestion.suggestion_id == suggestion_id))
+    status = result.scalar_one_or_none()
+    return SuggestionStatus(status) if status is not None else None
 
-        if not suggestions:
-            return None
 
-        # Deserializing entities
-        if suggestions[0].entities:
-            suggestions[0].entities = deserialize_entities(suggestions[0].entities)
-
-        return suggestions
+@track_query
+async def orm_get_suggestion(session: AsyncSession, suggestion_id: int) -> Suggestion | None:
+    try:
+        return await session.get(Suggestion, suggestion_id)
 
     except Exception as e:
         logging.exception(f"An error occurred", exc_info=e)
         return None
 
 
-async def orm_update_caption(session: AsyncSession,
-                             suggestion_id: int,
-                             caption: str,
-                             caption_entities: list[MessageEntity] | None):
-    if caption_entities:
-        serialized_entities = serialize_entities(caption_entities)
-    else:
-        serialized_entities = None
-    #entities_json = json.dumps(serialized_entities)
+@track_query
+async def orm_consume_throttle_token(session: AsyncSession, key: str, chat_id: int, capacity: int,
+                                     period: float) -> bool:
+    """Takes a token from the bucket of the chat in one atomic statement. Returns False if the bucket is empty"""
+    refilled = func.least(capacity,
+                          ThrottleBucket.tokens + func.extract('epoch', func.now() - ThrottleBucket.updated) / period)
+
+    # A new bucket starts full; an existing one is only updated if a token is left after the refill
+    query = (pg_insert(ThrottleBucket)
+             .values(key=key, chat_id=chat_id, tokens=capacity - 1)
+             .on_conflict_do_update(index_elements=[ThrottleBucket.key, ThrottleBucket.chat_id],
+                                    set_={'tokens': refilled - 1, 'updated': func.now()},
+                                    where=refilled >= 1)
+             .returning(ThrottleBucket.tokens))
+    result = await session.execute(query)
+    consumed = result.first() is not None
+    await session.commit()
+
+    return consumed
 
-    query = (update(Suggestion)
-             .where(Suggestion.suggestion_id == suggestion_id, Suggestion.caption is not None)
-             .values(caption=caption, entities=serialized_entities)
-             )
 
+@track_query
+async def orm_get_fsm_records(session: AsyncSession, keys: list[str]) -> dict[str, tuple[str | None, dict]]:
+    """Returns key -> (state, data) of the stored keys"""
+    query = select(FSMRecord.key, FSMRecord.state, FSMRecord.data).where(FSMRecord.key.in_(keys))
     result = await session.execute(query)
+    return {key: (state, data) for key, state, data in result.all()}
+
+
+@track_query
+async def orm_save_fsm_records(session: AsyncSession, records: dict[str, tuple[str | None, dict]]):
+    """Upserts key -> (state, data) in one statement; keys without state and data are deleted"""
+    empty_keys = [key for key, (state, data) in records.items() if state is None and not data]
+    rows = [{'key': key, 'state': state, 'data': data}
+            for key, (state, data) in records.items() if state is not None or data]
+
+    if empty_keys:
+        await session.execute(delete(FSMRecord).where(FSMRecord.key.in_(empty_keys)))
+    if rows:
+        query = pg_insert(FSMRecord).values(rows)
+        query = query.on_conflict_do_update(index_elements=[FSMRecord.key],
+                                            set_={'state': query.excluded.state,
+                                                  'data': query.excluded.data,
+                                                  'updated': func.now()})
+        await session.execute(query)
     await session.commit()
 
-    if result.rowcount == 0:
-        return False
 
-    return True
+@track_query
+async def orm_add_outbox_message(session: AsyncSession, kind: str, suggestion_id: int, requests: list[dict]):
+    """Adds Bot API requests to the outbox; they are written by the next commit of the session"""
+    session.add(OutboxMessage(kind=kind, suggestion_id=suggestion_id, requests=requests, results=[]))
+
+
+@track_query
+async def orm_claim_outbox_messages(session: AsyncSession, limit: int, lease: timedelta,
+                                    max_attempts: int) -> list[OutboxMessage]:
+    """
+    Takes up to `limit` due outbox messages for `lease` and counts the attempt.
+    Messages taken by a worker that died are due again when their lease ends.
+    """
+    due = (select(OutboxMessage.id)
+           .where(OutboxMessage.available_at <= func.now(), OutboxMessage.attempts < max_attempts)
+           .order_by(OutboxMessage.id)
+           .limit(limit)
+           .with_for_update(skip_locked=True)
+           .scalar_subquery())
+
+    query = (update(OutboxMessage)
+             .where(OutboxMessage.id.in_(due))
+             .values(attempts=OutboxMessage.attempts + 1, available_at=func.now() + lease)
+             .returning(OutboxMessage)
+             .execution_options(synchronize_session=False))
+    result = await session.execute(query)
+    messages = result.scalars().all()
+    await session.commit()
+
+    return messages
 
 
-async def orm_add_help_mess_id_for_suggestion(session: AsyncSession, suggestion_id: int, message_id: int):
-    query = update(Suggestion).where(Suggestion.suggestion_id == suggestion_id).values(
-        help_message=message_id)
+@track_query
+async def orm_save_outbox_progress(session: AsyncSession, message_id: int, results: list[list[int]]):
+    """Saves the results of the requests made so far, so a retry continues with the next request"""
+    query = update(OutboxMessage).where(OutboxMessage.id == message_id).values(results=results)
+    await session.execute(query)
+    await session.commit()
+
+
+@track_query
+async def orm_retry_outbox_message(session: AsyncSession, message_id: int, delay: timedelta, error: str):
+    query = (update(OutboxMessage)
+             .where(OutboxMessage.id == message_id)
+             .values(available_at=func.now() + delay, last_error=error[:1024]))
+    await session.execute(query)
+    await session.commit()
+
+
+@track_query
+async def orm_delete_outbox_message(session: AsyncSession, message_id: int):
+    await session.execute(delete(OutboxMessage).where(OutboxMessage.id == message_id))
+    await session.commit()
 
+
+@track_query
+async def orm_delete_dead_outbox_messages(session: AsyncSession, max_attempts: int, limit: int) -> list[OutboxMessage]:
+    """
+    Deletes up to `limit` outbox messages that failed `max_attempts` times and are not in flight (the lease of
+    the last attempt has ended) and returns them. The caller commits, together with the fate of their suggestions
+    """
+    dead = (select(OutboxMessage.id)
+            .where(OutboxMessage.attempts >= max_attempts, OutboxMessage.available_at <= func.now())
+            .order_by(OutboxMessage.id)
+            .limit(limit)
+            .with_for_update(skip_locked=True)
+            .scalar_subquery())
+
+    query = (delete(OutboxMessage)
+             .where(OutboxMessage.id.in_(dead))
+             .returning(OutboxMessage)
+             .execution_options(synchronize_session=False))
     result = await session.execute(query)
+    return result.scalars().all()
+
+
+@track_query
+async def orm_delete_undelivered_suggestions(session: AsyncSession, suggestion_ids: list[int]):
+    """Deletes pending suggestions that never reached the moderator chat, so they don't count to its load"""
+    query = (delete(Suggestion)
+             .where(Suggestion.suggestion_id.in_(suggestion_ids),
+                    Suggestion.status == SuggestionStatus.PENDING,
+                    Suggestion.mess_ids.is_(None))
+             .execution_options(synchronize_session=False))
+    await session.execute(query)
+
+
+@track_query
+async def orm_finish_failed_posts(session: AsyncSession, posted_ids: list[int], unposted_ids: list[int]):
+    """
+    Suggestions whose post gave up: those already copied to the channel are posted, the others are pending again,
+    so the moderator can post them once more
+    """
+    for suggestion_ids, status in ((posted_ids, SuggestionStatus.POSTED), (unposted_ids, SuggestionStatus.PENDING)):
+        if suggestion_ids:
+            query = (update(Suggestion)
+                     .where(Suggestion.suggestion_id.in_(suggestion_ids),
+                            Suggestion.status == SuggestionStatus.POSTING)
+                     .values(status=status)
+                     .execution_options(synchronize_session=False))
+            await session.execute(query)
+
+
+@track_query
+async def orm_complete_forward(session: AsyncSession, message_id: int, suggestion_id: int, mess_ids: list[int],
+                               help_message: int) -> bool:
+    """
+    Saves the ids of the messages sent to the moderator chat and deletes the outbox message in one transaction.
+    Returns False if the suggestion was deleted (expired or cleared) or rejected before it was forwarded.
+    """
+    query = (update(Suggestion)
+             .where(Suggestion.suggestion_id == suggestion_id, Suggestion.status == SuggestionStatus.PENDING)
+             .values(mess_ids=mess_ids, help_message=help_message))
+    result = await session.execute(query)
+
+    await session.execute(delete(OutboxMessage).where(OutboxMessage.id == message_id))
     await session.commit()
 
-    if result.rowcount == 0:
-        return False
+    return result.rowcount > 0
 
-    return True
+
+@track_query
+async def orm_complete_post(session: AsyncSession, message_id: int, suggestion_id: int):
+    """Marks the suggestion posted and deletes the outbox message in one transaction"""
+    query = (update(Suggestion)
+             .where(Suggestion.suggestion_id == suggestion_id, Suggestion.status == SuggestionStatus.POSTING)
+             .values(status=SuggestionStatus.POSTED))
+    await session.execute(query)
+
+    await session.execute(delete(OutboxMessage).where(OutboxMessage.id == message_id))
+    await session.commit()
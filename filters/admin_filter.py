@@ -1,11 +1,12 @@
 from aiogram.filters import BaseFilter
-from aiogram.types import Message
+from aiogram.types import CallbackQuery, Message
 
-from config import ADMIN_USER_ID
+from config import MODERATOR_IDS
 
 
 class AdminFilter(BaseFilter):
+    """Passes messages and callback queries of moderators (the admin is one of them)"""
     is_admin: bool = True
 
-    async def __call__(self, obj: Message) -> bool:
-        return (obj.from_user.id == int(ADMIN_USER_ID)) == self.is_admin
+    async def __call__(self, obj: Message | CallbackQuery) -> bool:
+        return (obj.from_user.id in MODERATOR_IDS) == self.is_admin
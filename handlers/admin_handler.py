@@ -1,4 +1,5 @@
 import logging
+import math
 
 from aiogram import Router, F
 from aiogram.filters import CommandStart, Command, CommandObject
@@ -6,13 +7,17 @@ from aiogram.fsm.context import FSMContext
 from aiogram.types import Message, CallbackQuery
 from sqlalchemy.ext.asyncio import AsyncSession
 
-from database.orm_query import orm_get_user, orm_unblock_user, orm_get_banned_users, orm_get_and_delete_all_suggestions
-from keyboards.inline import create_ok_menu
+from database.orm_query import orm_get_user, orm_unblock_user, orm_get_banned_users_page, orm_count_banned_users
+from keyboards.inline import create_ok_menu, create_banlist_keyboard, BanlistCallBack
 from keyboards.reply import admin_reply_keyboard
+from scripts.clear_db_admin_chat import clear_moderator_chat
 
-from config import TEXT_MESSAGES
+from config import TEXT_MESSAGES, BANLIST_PAGE_SIZE
 
-admin_router = Router()
+admin_router = Router(name="admin_router")
+
+# /banlist counts banned users up to this number, more are shown as "N+" pages
+BANLIST_COUNT_LIMIT = 10_000
 
 
 @admin_router.message(CommandStart())
@@ -20,20 +25,61 @@ async def admin_start(message: Message):
     await message.answer(TEXT_MESSAGES['admin_start'], reply_markup=admin_reply_keyboard())
 
 
+async def build_banlist_page(session: AsyncSession, page: int, total: int,
+                             after: int | None = None, before: int | None = None):
+    """Returns the text and the keyboard of a banlist page that starts after `after` or ends before `before`"""
+    # One extra id shows if there is one more page in the direction of the query
+    user_ids = await orm_get_banned_users_page(session, BANLIST_PAGE_SIZE + 1, after=after, before=before)
+    has_more = len(user_ids) > BANLIST_PAGE_SIZE
+    if before is not None:
+        user_ids = user_ids[-BANLIST_PAGE_SIZE:]
+        has_prev, has_next = has_more, True
+    else:
+        user_ids = user_ids[:BANLIST_PAGE_SIZE]
+        has_prev, has_next = page > 1, has_more
+
+    pages = max(math.ceil(total / BANLIST_PAGE_SIZE), 1)
+    pages_text = f"{pages}+" if total >= BANLIST_COUNT_LIMIT else str(pages)
+
+    text = TEXT_MESSAGES['list_of_banned'] + " " + TEXT_MESSAGES['banlist_page'].format(page, pages_text) + ":\n"
+    for user_id in user_ids:
+        text += f"[{user_id}](tg://user?id={user_id})\n"
+
+    text += "\n" + TEXT_MESSAGES['to_unblock_enter']
+
+    keyboard = create_banlist_keyboard(first_user_id=user_ids[0] if user_ids else None,
+                                       last_user_id=user_ids[-1] if user_ids else None,
+                                       page=page,
+                                       total=total,
+                                       has_prev=has_prev and bool(user_ids),
+                                       has_next=has_next and bool(user_ids))
+    return text, keyboard
+
+
 @admin_router.message(Command('banlist'))
 @admin_router.message(F.text == TEXT_MESSAGES['banlist'])
 async def show_banlist(message: Message, session: AsyncSession):
-    text = TEXT_MESSAGES['list_of_banned'] + ":\n"
-    banned_users = await orm_get_banned_users(session)
+    total = await orm_count_banned_users(session, BANLIST_COUNT_LIMIT)
+    text, keyboard = await build_banlist_page(session, page=1, total=total)
+    # Return the connection to the pool before the Bot API calls
+    await session.close()
 
-    for user in banned_users:
-        text += f"[{user.user_id}](tg://user?id={user.user_id})\n"
+    await message.delete()
+    await message.answer(text, parse_mode="Markdown", reply_markup=keyboard)
 
 
-    text += "\n" + TEXT_MESSAGES['to_unblock_enter']
+@admin_router.callback_query(BanlistCallBack.filter())
+async def show_banlist_page(query: CallbackQuery, session: AsyncSession, callback_data: BanlistCallBack):
+    if callback_data.direction == "prev":
+        text, keyboard = await build_banlist_page(session, callback_data.page, callback_data.total,
+                                                  before=callback_data.user_id)
+    else:
+        text, keyboard = await build_banlist_page(session, callback_data.page, callback_data.total,
+                                                  after=callback_data.user_id)
+    await session.close()
 
-    await message.delete()
-    await message.answer(text, parse_mode="Markdown", reply_markup=create_ok_menu())
+    await query.message.edit_text(text, parse_mode="Markdown", reply_markup=keyboard)
+    await query.answer()
 
 
 @admin_router.callback_query(F.data == 'delete_mes')
@@ -76,15 +122,6 @@ async def unblock(message: Message, session: AsyncSession, command: CommandObjec
 @admin_router.message(F.text == TEXT_MESSAGES['rm'])
 async def admin_remove_chat(message: Message, session: AsyncSession, state: FSMContext):
     await message.delete()
-
-    suggestions = await orm_get_and_delete_all_suggestions(session)
-
-    suggestions_ids = list((suggestion.mess_id for suggestion in suggestions))
-    help_message_ids = list((suggestion.help_message for suggestion in suggestions))
-
-    if suggestions_ids and help_message_ids:
-        await message.bot.delete_messages(chat_id=message.chat.id, message_ids=suggestions_ids)
-        await message.bot.delete_messages(chat_id=message.chat.id, message_ids=help_message_ids)
-
+    await clear_moderator_chat(message, session)
     await state.clear()
 
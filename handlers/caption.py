@@ -0,0 +1,56 @@
+"""
+Composes the text of a suggestion for the moderator chat: the user's text, a blank line and LINK_TEXT linked to LINK.
+
+Telegram measures lengths and entity offsets in UTF-16 code units, where characters outside the BMP (most emoji)
+take two units, so the offset of the link is the UTF-16 length of everything before it, not len().
+"""
+from aiogram.types import MessageEntity
+
+from config import LINK, LINK_TEXT
+
+# Bot API limits in UTF-16 code units
+CAPTION_LIMIT = 1024
+TEXT_LIMIT = 4096
+
+
+def utf16_length(text: str) -> int:
+    if text.isascii():
+        # O(1) in CPython, the common case needs no encoding
+        return len(text)
+    return len(text.encode('utf-16-le')) // 2
+
+
+class CaptionComposer:
+    def __init__(self, link_text: str, link: str, separator: str = '\n\n'):
+        self.link = link
+        self.link_text = link_text
+        self.suffix = separator + link_text
+        # Computed once, only the user's text is measured per message
+        self.link_length = utf16_length(link_text)
+        self.suffix_length = utf16_length(self.suffix)
+
+    def max_text_length(self, limit: int) -> int:
+        """The longest user's text (in UTF-16 code units) that fits in `limit` together with the link"""
+        return limit - self.suffix_length
+
+    def compose(self, text: str | None, entities: list[MessageEntity] | None,
+                limit: int) -> tuple[str, list[MessageEntity]] | None:
+        """
+        Returns the text with the link appended and the user's entities followed by the link entity,
+        or None if it doesn't fit in `limit`. A message without text gets just the link.
+        """
+        if not text:
+            return self.link_text, [self.link_entity(0)]
+
+        text_length = utf16_length(text)
+        if text_length > self.max_text_length(limit):
+            return None
+
+        link_offset = text_length + self.suffix_length - self.link_length
+        return text + self.suffix, [*(entities or ()), self.link_entity(link_offset)]
+
+    def link_entity(self, offset: int) -> MessageEntity:
+        return MessageEntity(type='text_link', offset=offset, length=self.link_length, url=self.link)
+
+
+composer = CaptionComposer(LINK_TEXT, LINK)
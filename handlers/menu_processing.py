@@ -1,76 +1,127 @@
+import asyncio
+import functools
 import logging
 
 from aiogram import Router, F
 from aiogram.fsm.state import StatesGroup, State
-from aiogram.types import Message, CallbackQuery, InputMediaPhoto
+from aiogram.methods import CopyMessage, CopyMessages, DeleteMessages
+from aiogram.types import Message, CallbackQuery
 from sqlalchemy.ext.asyncio import AsyncSession
 
 from config import TEXT_MESSAGES, CHANNEL_ID
-from database.orm_query import orm_extract_suggestions, orm_block_user_by_sug_id, orm_get_suggestions, \
-    orm_update_caption
+from database.models import SuggestionKind, SuggestionStatus
+from database.orm_query import orm_claim_suggestion, orm_block_user_by_sug_id, orm_get_suggestion, \
+    orm_add_outbox_message, orm_get_suggestion_status
 from keyboards.inline import create_edit_menu_keyboard, create_main_menu_keyboard, MenuCallBack, create_ok_menu
 from aiogram.fsm.context import FSMContext
+from metrics import REPEATED_CALLBACKS
+from scripts.clear_db_admin_chat import delete_chat_messages
+from scripts.outbox import POST, OutboxWorker, dump_request
 
-main_menu_router = Router()
+main_menu_router = Router(name="main_menu_router")
 
 
 class EditMessage(StatesGroup):
     edit_text = State()
 
 
-@main_menu_router.callback_query(MenuCallBack.filter(F.data == "post"))
-async def post_in_the_channel(query: CallbackQuery, session: AsyncSession, callback_data: MenuCallBack):
-    suggestion_id = callback_data.suggestion_id
+# Suggestions whose post or reject is being handled by this process. All callbacks of a moderator chat reach
+# the same process (see scripts/worker_pool.py), so a double tap is answered here without a database query
+in_flight: set[int] = set()
 
-    suggestions = await orm_extract_suggestions(session, suggestion_id)
-    suggestions.sort(key=lambda x: x.id)
+STATUS_TEXTS = {
+    SuggestionStatus.PENDING: 'try_again',
+    SuggestionStatus.POSTING: 'in_progress',
+    SuggestionStatus.POSTED: 'already_posted',
+    SuggestionStatus.REJECTED: 'already_rejected',
+}
 
-    if len(suggestions) == 1:
-        # An option if you need to send one text message or a message with one photo
-        await query.bot.copy_message(chat_id=CHANNEL_ID,
-                                     from_chat_id=query.from_user.id,
-                                     message_id=suggestions[0].mess_id)
-        await query.bot.delete_message(chat_id=query.from_user.id, message_id=suggestions[0].mess_id)
-    else:
-        # An option if you need to send album of photos
-        # A new media group is being formed based on information from the database
-        caption = suggestions[0].caption
-        entities = suggestions[0].entities
-        media_group = [InputMediaPhoto(media=suggestion.file_id,
-                                       caption=caption if idx == 0 else '',
-                                       caption_entities=entities if idx == 0 else None
-                                       )
-                       for idx, suggestion in enumerate(suggestions)]
-        await query.bot.send_media_group(CHANNEL_ID, media_group)
-        for suggestion in suggestions:
-            await query.bot.delete_message(chat_id=query.from_user.id, message_id=suggestion.mess_id)
 
-    await query.answer(text=TEXT_MESSAGES['posted'], show_alert=True)
-    await query.message.delete()
+def once_per_suggestion(handler):
+    """
+    Post/reject handlers: a callback for a suggestion that is in flight in this process or is no longer
+    pending is answered with the status of the suggestion instead of repeating the action
+    """
 
+    @functools.wraps(handler)
+    async def wrapper(query: CallbackQuery, session: AsyncSession, callback_data: MenuCallBack, **kwargs):
+        suggestion_id = callback_data.suggestion_id
+        if suggestion_id in in_flight:
+            REPEATED_CALLBACKS.labels('in_flight').inc()
+            await query.answer(text=TEXT_MESSAGES['in_progress'], show_alert=True)
+            return
 
+        in_flight.add(suggestion_id)
+        try:
+            if await handler(query, session=session, callback_data=callback_data, **kwargs):
+                return
+            # Another process, the expiry sweeper or an earlier callback got the suggestion first,
+            # a suggestion still pending means the claim itself failed
+            status = await orm_get_suggestion_status(session, suggestion_id)
+        finally:
+            in_flight.discard(suggestion_id)
 
+        REPEATED_CALLBACKS.labels(status or 'deleted').inc()
+        await query.answer(text=TEXT_MESSAGES[STATUS_TEXTS.get(status, 'already_handled')], show_alert=True)
 
+    return wrapper
 
 
-@main_menu_router.callback_query(MenuCallBack.filter(F.data == "reject"))
-async def reject_callback(query: CallbackQuery, session: AsyncSession, callback_data: MenuCallBack):
-    await query.answer()
+@main_menu_router.callback_query(MenuCallBack.filter(F.data == "post"))
+@once_per_suggestion
+async def post_in_the_channel(query: CallbackQuery, session: AsyncSession, outbox: OutboxWorker,
+                              callback_data: MenuCallBack) -> bool:
+    """Returns False if the suggestion is no longer pending"""
     suggestion_id = callback_data.suggestion_id
 
-    # finding record where suggestion.suggestion_id == suggestion_id
-    suggestions = await orm_extract_suggestions(session, suggestion_id)
-    await query.message.delete()
-
-    if suggestions:
-        for suggestion in suggestions:
-            try:
-                await query.bot.delete_message(query.message.chat.id, suggestion.mess_id)
-            except Exception as e:
-                logging.error("The message in the admin chat could not be deleted. Incorrect suggestion_id passed",
-                              exc_info=e)
+    suggestion = await orm_claim_suggestion(session, suggestion_id, SuggestionStatus.POSTING, commit=False)
+    if suggestion is None:
+        return False
+
+    mess_ids = suggestion.mess_ids
+    if not mess_ids:
+        # The outbox worker has sent the messages but not saved their ids yet, the suggestion stays pending
+        await session.rollback()
+        await query.answer(text=TEXT_MESSAGES['not_ready'], show_alert=True)
+        return True
+
+    # The messages in the moderator chat already carry the edited caption, so they are copied as they are:
+    # no files are sent again and an album takes one call whatever the number of photos
+    if len(mess_ids) == 1:
+        post = CopyMessage(chat_id=CHANNEL_ID, from_chat_id=query.message.chat.id, message_id=mess_ids[0])
     else:
-        logging.error("No suggestions found.")
+        # Copied albums keep their grouping, the ids must be in increasing order
+        post = CopyMessages(chat_id=CHANNEL_ID, from_chat_id=query.message.chat.id, message_ids=mess_ids)
+
+    # The suggestion and its help message are removed from the moderator chat after the post
+    cleanup = DeleteMessages(chat_id=query.message.chat.id, message_ids=mess_ids + [query.message.message_id])
+
+    # The claim and the outbox message are committed together, the worker posts after the commit
+    # and marks the suggestion posted
+    await orm_add_outbox_message(session, POST, suggestion_id, [dump_request(post), dump_request(cleanup)])
+    await session.commit()
+    outbox.notify()
+
+    await query.answer(text=TEXT_MESSAGES['posted'], show_alert=True)
+    return True
+
+
+@main_menu_router.callback_query(MenuCallBack.filter(F.data == "reject"))
+@once_per_suggestion
+async def reject_callback(query: CallbackQuery, session: AsyncSession, callback_data: MenuCallBack) -> bool:
+    """Returns False if the suggestion is no longer pending"""
+    suggestion = await orm_claim_suggestion(session, callback_data.suggestion_id, SuggestionStatus.REJECTED)
+    if suggestion is None:
+        return False
+
+    # The suggestion and its help message go in one deleteMessages call, made together with the answer.
+    # A suggestion without mess_ids is still in the outbox, the outbox deletes it when it finds it rejected
+    message_ids = suggestion.mess_ids or []
+    # bot(method) makes a coroutine of the method object, which gather() can't take as it is
+    await asyncio.gather(query.bot(query.answer()),
+                         delete_chat_messages(query.bot, query.message.chat.id,
+                                              message_ids + [query.message.message_id]))
+    return True
 
 
 
@@ -116,40 +167,42 @@ async def edit_text_message(message: Message, session: AsyncSession, state: FSMC
     data = await state.get_data()
     suggestion_id = data['suggestion_id']
 
-    suggestions = await orm_get_suggestions(session, suggestion_id)
+    suggestion = await orm_get_suggestion(session, suggestion_id)
+    # Return the connection to the pool before the Bot API calls
+    await session.close()
 
-    # If suggestion is an album
-    if len(suggestions) > 1:
-        try:
-            if await message.bot.edit_message_caption(chat_id=message.chat.id,
-                                                      message_id=suggestions[0].mess_id,
-                                                      caption=text,
-                                                      caption_entities=entities
-                                                      ):
-                if not await orm_update_caption(session,
-                                                suggestions[0].suggestion_id,
-                                                caption=text,
-                                                caption_entities=entities):
-                    await message.answer(text="The message could not be edited.", show_alert=True)
-        except Exception as e:
-            logging.error("The message in the admin chat could not be edited.", exc_info=e)
+    if suggestion is None or not suggestion.mess_ids or suggestion.status != SuggestionStatus.PENDING:
+        logging.error("No suggestions found.")
 
-    # If suggestion is one message with photo or text only
-    elif len(suggestions) == 1:
-        try:
-            await message.bot.edit_message_text(chat_id=message.chat.id,
-                                                message_id=suggestions[0].mess_id,
-                                                text=text,
-                                                entities=entities)
-        except:
-            logging.error("The message in the admin chat could not be edited.")
+    # If suggestion is an album, the caption is on the first photo
+    elif suggestion.kind == SuggestionKind.ALBUM:
+        # The post is copied from the moderator chat, so the edited message is all that needs to change
         try:
             await message.bot.edit_message_caption(chat_id=message.chat.id,
-                                                   message_id=suggestions[0].mess_id,
+                                                   message_id=suggestion.mess_ids[0],
                                                    caption=text,
                                                    caption_entities=entities)
-        except:
-            logging.error("The message in the admin chat could not be edited.")
+        except Exception as e:
+            logging.error("The message in the admin chat could not be edited.", exc_info=e)
+
+    # If suggestion is one message with photo or text only (either for suggestions without a kind)
+    else:
+        if suggestion.kind != SuggestionKind.PHOTO:
+            try:
+                await message.bot.edit_message_text(chat_id=message.chat.id,
+                                                    message_id=suggestion.mess_ids[0],
+                                                    text=text,
+                                                    entities=entities)
+            except:
+                logging.error("The message in the admin chat could not be edited.")
+        if suggestion.kind != SuggestionKind.TEXT:
+            try:
+                await message.bot.edit_message_caption(chat_id=message.chat.id,
+                                                       message_id=suggestion.mess_ids[0],
+                                                       caption=text,
+                                                       caption_entities=entities)
+            except:
+                logging.error("The message in the admin chat could not be edited.")
 
     await state.clear()
     await message.delete()
@@ -1,44 +1,110 @@
+import hashlib
 import logging
+import re
+import unicodedata
+from datetime import timedelta
+from functools import partial
+from typing import Callable
 
 from aiogram import Router, F
 from aiogram.filters import CommandStart
-from aiogram.types import Message, InputMediaPhoto, MessageEntity
-from apscheduler.schedulers.asyncio import AsyncIOScheduler
+from aiogram.methods import SendMediaGroup, SendMessage, SendPhoto, TelegramMethod
+from aiogram.types import Message, InputMediaPhoto
 
 from sqlalchemy.ext.asyncio import AsyncSession
 
-from config import TEXT_MESSAGES, ADMIN_USER_ID, LINK, LINK_TEXT
+from config import TEXT_MESSAGES, MODERATOR_IDS, MODERATOR_ASSIGNMENT, DUPLICATE_WINDOW_HOURS
 
-from database.orm_query import orm_add_user, orm_add_new_suggestion, orm_add_new_suggestions, \
-    orm_add_help_mess_id_for_suggestion
+from database.models import SuggestionKind
+from database.orm_query import orm_add_new_suggestion, orm_next_suggestion_id, orm_next_suggestion_id_and_moderator, \
+    orm_add_outbox_message, orm_remember_fingerprint
 
+from handlers.caption import CAPTION_LIMIT, TEXT_LIMIT, composer
 from keyboards.inline import create_main_menu_keyboard
-from scripts.clear_db_admin_chat import schedule_message_deletion
+from scripts.outbox import FORWARD, OutboxWorker, dump_request
 
-user_router = Router()
+user_router = Router(name="user_router")
 flags = {"throttling_key": "default"}
 
 
-async def send_inline_keyboard(message: Message, suggestion_id: int):
-    """A common function for handlers. Creates help message with inline keyboard. Returns its id"""
-    return await message.bot.send_message(chat_id=ADMIN_USER_ID,
-                                          text=TEXT_MESSAGES['choose'],
-                                          reply_markup=create_main_menu_keyboard(message.from_user.id, suggestion_id))
+def content_fingerprint(kind: str, parts: list[str]) -> str:
+    return hashlib.blake2b('\x1f'.join([kind, *parts]).encode(), digest_size=16).hexdigest()
 
 
-@user_router.message(CommandStart())
-async def user_start(message: Message, session: AsyncSession):
-    user_id = message.from_user.id
+def text_fingerprint(text: str) -> str:
+    """Equal for texts that differ only in case, punctuation, spacing and formatting"""
+    words = re.findall(r'\w+', unicodedata.normalize('NFKC', text).casefold())
+    return content_fingerprint('text', words or [text.strip()])
+
+
+def photos_fingerprint(file_unique_ids: list[str]) -> str:
+    """Equal for the same photos in any order, whatever the caption; file_unique_id is the same for resent files"""
+    return content_fingerprint('photo', sorted(file_unique_ids))
+
+
+async def assign_suggestion(session: AsyncSession) -> tuple[int, int]:
+    """Returns the id of a new suggestion and the moderator who will review it"""
+    if MODERATOR_ASSIGNMENT == 'round_robin' or len(MODERATOR_IDS) == 1:
+        suggestion_id = await orm_next_suggestion_id(session)
+        return suggestion_id, MODERATOR_IDS[suggestion_id % len(MODERATOR_IDS)]
+    return await orm_next_suggestion_id_and_moderator(session, MODERATOR_IDS)
+
+
+def inline_keyboard_request(message: Message, moderator_id: int, suggestion_id: int) -> SendMessage:
+    """A common function for handlers. Creates the help message with inline keyboard for the moderator chat"""
+    return SendMessage(chat_id=moderator_id,
+                       text=TEXT_MESSAGES['choose'],
+                       reply_markup=create_main_menu_keyboard(message.from_user.id, suggestion_id))
+
+
+async def forward_suggestion(message: Message,
+                             session: AsyncSession,
+                             outbox: OutboxWorker,
+                             content: Callable[..., TelegramMethod],
+                             fingerprint: str,
+                             kind: SuggestionKind):
+    """
+    A common function for handlers. Assigns the suggestion to a moderator and saves it in one transaction
+    with the outbox message that sends the content (`content` is called with chat_id) and the help message
+    to the moderator chat, then answers the user. The outbox worker sends the messages after the commit.
+    Content the user has already sent within DUPLICATE_WINDOW_HOURS (by `fingerprint`) is rejected.
+    """
     try:
-        await orm_add_user(session, user_id)
+        if DUPLICATE_WINDOW_HOURS and not await orm_remember_fingerprint(session,
+                                                                         message.from_user.id,
+                                                                         fingerprint,
+                                                                         timedelta(hours=DUPLICATE_WINDOW_HOURS)):
+            await message.reply(TEXT_MESSAGES['duplicate'])
+            return
+
+        suggestion_id, moderator_id = await assign_suggestion(session)
+
+        requests = [content(chat_id=moderator_id), inline_keyboard_request(message, moderator_id, suggestion_id)]
+        await orm_add_outbox_message(session, FORWARD, suggestion_id, [dump_request(request) for request in requests])
+
+        await orm_add_new_suggestion(session,
+                                     message.from_user.id,
+                                     moderator_id,
+                                     suggestion_id,
+                                     kind)
     except Exception as e:
-        logging.exception("The user entered /start again", exc_info=e)
+        logging.exception("The suggestion could not be saved", exc_info=e)
+        await session.rollback()
+        await message.reply(TEXT_MESSAGES['not_delivered'])
+        return
 
+    outbox.notify()
+    await message.reply(TEXT_MESSAGES['pending'])
+
+
+@user_router.message(CommandStart())
+async def user_start(message: Message):
+    # The user is registered by ACLMiddleware
     await message.reply(TEXT_MESSAGES['start'])
 
 
 @user_router.message(F.media_group_id, flags=flags)
-async def handle_photo_albums(message: Message, session: AsyncSession, scheduler: AsyncIOScheduler, album: list = None):
+async def handle_photo_albums(message: Message, session: AsyncSession, outbox: OutboxWorker, album: list = None):
     """A handler for working with photo albums sent by the user."""
 
     # Limit on the number of messages in an album
@@ -46,22 +112,12 @@ async def handle_photo_albums(message: Message, session: AsyncSession, scheduler
         await message.reply(TEXT_MESSAGES['album_limit'])
         return
 
-    user_id = message.from_user.id
-    caption = album[0].caption if album[0].caption else ""
-
-    # Adding the link text to the end
-    caption += f"\n\n{LINK_TEXT}"
-
-    # Creating a new entity for the link
-    if album[0].caption_entities:
-        caption_entities = list(album[0].caption_entities)
-    else:
-        caption_entities = []
-
-    # Adding entity of link to the caption_entities
-    start_index = len(caption) - len(LINK_TEXT)
-    link_entity = MessageEntity(type="text_link", offset=start_index, length=len(LINK_TEXT), url=LINK)
-    caption_entities.append(link_entity)
+    # Adding the link to the end of the caption
+    composed = composer.compose(album[0].caption, album[0].caption_entities, CAPTION_LIMIT)
+    if composed is None:
+        await message.reply(TEXT_MESSAGES['too_long'].format(composer.max_text_length(CAPTION_LIMIT)))
+        return
+    caption, caption_entities = composed
 
     # Creating a list of media to send the album, adding a caption only to the first photo
     media_group = [InputMediaPhoto(media=media.photo[-1].file_id,
@@ -69,131 +125,58 @@ async def handle_photo_albums(message: Message, session: AsyncSession, scheduler
                                    caption_entities=caption_entities if idx == 0 else None)
                    for idx, media in enumerate(album)]
 
-    # Sending the media group to the administrator and get a list of new messages to receive IDs
-    new_messages = await message.bot.send_media_group(ADMIN_USER_ID, media_group)
-    mess_ids = [mess_id.message_id for mess_id in new_messages]
-
-    # Getting ids of files
-    file_ids = []
-    for idx, media in enumerate(album):
-        file_ids.append(media.photo[-1].file_id)
-
-    # Zipping ids for saving in db
-    file_ids_with_mess_ids = zip(mess_ids, file_ids)
-
-    try:
-        suggestion_id = await orm_add_new_suggestions(session,
-                                                      user_id,
-                                                      file_ids_with_mess_ids=file_ids_with_mess_ids,
-                                                      caption=caption,
-                                                      entities=caption_entities)
-        # Plan to delete the message in 47 hours
-        await schedule_message_deletion(
-            bot=message.bot,
-            session=session,
-            message_ids=mess_ids,
-            suggestion_id=suggestion_id,
-            scheduler=scheduler
-        )
-        help_message = await send_inline_keyboard(message, suggestion_id)
-        await orm_add_help_mess_id_for_suggestion(session, suggestion_id, help_message.message_id)
-
-    except Exception as e:
-        logging.exception("The suggestion could not be written to the database", exc_info=e)
-
-    await message.reply(TEXT_MESSAGES['pending'])
+    # Sending the media group to the moderator
+    await forward_suggestion(message,
+                             session,
+                             outbox,
+                             content=partial(SendMediaGroup, media=media_group),
+                             fingerprint=photos_fingerprint([media.photo[-1].file_unique_id for media in album]),
+                             kind=SuggestionKind.ALBUM)
 
 
 @user_router.message(F.photo, flags=flags)
-async def handle_message_with_photo(message: Message, session: AsyncSession, scheduler: AsyncIOScheduler):
-    user_id = message.from_user.id
-
-    # Set caption
-    caption = message.caption if message.caption else ""
-    # Adding the link text to the end
-    caption += f"\n\n{LINK_TEXT}"
-
-    # Set entities
-    if message.caption_entities:
-        caption_entities = list(message.caption_entities)
-    else:
-        caption_entities = []
-    start_index = len(caption) - len(LINK_TEXT)
-    link_entity = MessageEntity(type="text_link", offset=start_index, length=len(LINK_TEXT), url=LINK)
-    caption_entities.append(link_entity)
+async def handle_message_with_photo(message: Message, session: AsyncSession, outbox: OutboxWorker):
+    # Adding the link to the end of the caption
+    composed = composer.compose(message.caption, message.caption_entities, CAPTION_LIMIT)
+    if composed is None:
+        await message.reply(TEXT_MESSAGES['too_long'].format(composer.max_text_length(CAPTION_LIMIT)))
+        return
+    caption, caption_entities = composed
 
     # Send new message
-    new_message = await message.bot.send_photo(
-        chat_id=ADMIN_USER_ID,
-        photo=message.photo[-1].file_id,
-        caption=caption,
-        caption_entities=caption_entities
-    )
-
-    try:
-        suggestion_id = await orm_add_new_suggestion(session, user_id, new_message.message_id)
-
-        # Plan to delete the message in 47 hours
-        await schedule_message_deletion(
-            bot=message.bot,
-            session=session,
-            message_ids=[new_message.message_id],
-            suggestion_id=suggestion_id,
-            scheduler=scheduler
-        )
-
-        help_message = await send_inline_keyboard(message, suggestion_id)
-        await orm_add_help_mess_id_for_suggestion(session, suggestion_id, help_message.message_id)
-
-    except Exception as e:
-        logging.exception("The suggestion could not be written to the database", exc_info=e)
-
-    await message.reply(TEXT_MESSAGES['pending'])
+    await forward_suggestion(message,
+                             session,
+                             outbox,
+                             content=partial(
+                                 SendPhoto,
+                                 photo=message.photo[-1].file_id,
+                                 caption=caption,
+                                 caption_entities=caption_entities
+                             ),
+                             fingerprint=photos_fingerprint([message.photo[-1].file_unique_id]),
+                             kind=SuggestionKind.PHOTO)
 
 
 @user_router.message(F.text, flags=flags)
-async def handle_message_with_text(message: Message, session: AsyncSession, scheduler: AsyncIOScheduler):
-    user_id = message.from_user.id
-
-    # Set text
-    message_text = message.text if message.text else ""
-    # Adding the link text to the end
-    message_text += f"\n\n{LINK_TEXT}"
-
-    # Set entities
-    if message.entities:
-        entities = list(message.entities)
-    else:
-        entities = []
-    start_index = len(message_text) - len(LINK_TEXT)
-    link_entity = MessageEntity(type="text_link", offset=start_index, length=len(LINK_TEXT), url=LINK)
-    entities.append(link_entity)
+async def handle_message_with_text(message: Message, session: AsyncSession, outbox: OutboxWorker):
+    # Adding the link to the end of the text
+    composed = composer.compose(message.text, message.entities, TEXT_LIMIT)
+    if composed is None:
+        await message.reply(TEXT_MESSAGES['too_long'].format(composer.max_text_length(TEXT_LIMIT)))
+        return
+    message_text, entities = composed
 
     # Send new message
-    new_message = await message.bot.send_message(
-        chat_id=ADMIN_USER_ID,
-        text=message_text,
-        entities=entities
-    )
-
-    try:
-        suggestion_id = await orm_add_new_suggestion(session, user_id, new_message.message_id)
-
-        # Plan to delete the message in 47 hours
-        await schedule_message_deletion(
-            bot=message.bot,
-            session=session,
-            message_ids=[new_message.message_id],
-            suggestion_id=suggestion_id,
-            scheduler=scheduler
-        )
-
-        help_message = await send_inline_keyboard(message, suggestion_id)
-        await orm_add_help_mess_id_for_suggestion(session, suggestion_id, help_message.message_id)
-    except Exception as e:
-        logging.exception("The suggestion could not be written to the database", exc_info=e)
-
-    await message.reply(TEXT_MESSAGES['pending'])
+    await forward_suggestion(message,
+                             session,
+                             outbox,
+                             content=partial(
+                                 SendMessage,
+                                 text=message_text,
+                                 entities=entities
+                             ),
+                             fingerprint=text_fingerprint(message.text),
+                             kind=SuggestionKind.TEXT)
 
 
 @user_router.message(F.sticker | F.gif | F.video | F.voice | F.document)
@@ -10,6 +10,14 @@ class MenuCallBack(CallbackData, prefix="menu"):
     data: str
 
 
+class BanlistCallBack(CallbackData, prefix="banlist"):
+    """A banlist page that starts after (or ends before) the banned user `user_id`"""
+    direction: str  # "next" or "prev"
+    user_id: int
+    page: int
+    total: int  # counted once by /banlist and carried between pages
+
+
 def create_main_menu_keyboard(user_id, suggestion_id):
     keyboard = InlineKeyboardBuilder()
 
@@ -65,4 +73,27 @@ def create_ok_menu():
             )]
         ]
     )
-    return keyboard
\ No newline at end of file
+    return keyboard
+
+
+def create_banlist_keyboard(first_user_id: int | None, last_user_id: int | None, page: int, total: int,
+                            has_prev: bool, has_next: bool):
+    keyboard = InlineKeyboardBuilder()
+
+    if has_prev:
+        keyboard.button(
+            text="⬅️",
+            callback_data=BanlistCallBack(direction="prev", user_id=first_user_id, page=page - 1, total=total)
+        )
+    if has_next:
+        keyboard.button(
+            text="➡️",
+            callback_data=BanlistCallBack(direction="next", user_id=last_user_id, page=page + 1, total=total)
+        )
+    keyboard.button(
+        text='✅OK',
+        callback_data="delete_mes"
+    )
+    keyboard.adjust(int(has_prev) + int(has_next) or 1, 1)
+
+    return keyboard.as_markup()
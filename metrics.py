@@ -0,0 +1,63 @@
+import functools
+import time
+
+from aiohttp import web
+from prometheus_client import CONTENT_TYPE_LATEST, Counter, Gauge, Histogram, generate_latest
+
+# Updates
+HANDLER_SECONDS = Histogram('bot_handler_seconds', 'Time spent in a handler and the middlewares of its router',
+                            ['router', 'handler'])
+ALBUM_BUFFERED_GROUPS = Gauge('bot_album_buffered_groups', 'Media groups waiting for the rest of their parts')
+ALBUM_ASSEMBLY_SECONDS = Histogram('bot_album_assembly_seconds', 'Time from the first part of an album to the handler')
+THROTTLE_CACHE_SIZE = Gauge('bot_throttle_cache_size', 'Token buckets kept in memory by the throttling middleware')
+USER_CACHE_USERS = Gauge('bot_user_cache_size', 'Users cached by ACLMiddleware')
+USER_CACHE_HIT_RATE = Gauge('bot_user_cache_hit_rate', 'Share of ACLMiddleware lookups answered from the cache')
+SCHEDULER_JOBS = Gauge('bot_scheduler_jobs', 'Jobs in the scheduler job store')
+REPEATED_CALLBACKS = Counter('bot_repeated_callbacks_total',
+                             'Post/reject callbacks answered without repeating the action, by the suggestion status',
+                             ['status'])
+
+# Database
+DB_QUERY_SECONDS = Histogram('bot_db_query_seconds', 'Time of an orm_query function', ['query'])
+DB_POOL_WAIT_SECONDS = Histogram('bot_db_pool_wait_seconds',
+                                 'Time to get a connection from the pool, including opening a new one')
+DB_POOL_CHECKED_OUT = Gauge('bot_db_pool_checked_out', 'Connections currently checked out of the pool')
+DB_POOL_OVERFLOW = Gauge('bot_db_pool_overflow', 'Connections opened above the pool size')
+
+# Bot API
+BOT_API_SECONDS = Histogram('bot_api_request_seconds', 'Time of a Bot API request', ['method'])
+BOT_API_ERRORS = Counter('bot_api_errors_total', 'Failed Bot API requests', ['method', 'error'])
+OUTBOX_MESSAGES = Counter('bot_outbox_messages_total', 'Outbox messages processed by the worker', ['kind', 'result'])
+
+
+def track_query(func):
+    """Decorator for orm_query functions, observes their time in DB_QUERY_SECONDS"""
+    histogram = DB_QUERY_SECONDS.labels(func.__name__)
+
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return await func(*args, **kwargs)
+        finally:
+            histogram.observe(time.perf_counter() - started)
+
+    return wrapper
+
+
+async def metrics_handler(request: web.Request) -> web.Response:
+    return web.Response(body=generate_latest(), headers={'Content-Type': CONTENT_TYPE_LATEST})
+
+
+def setup_metrics_route(app: web.Application, path: str = '/metrics'):
+    app.router.add_get(path, metrics_handler)
+
+
+async def start_metrics_server(host: str, port: int) -> web.AppRunner:
+    """Serves /metrics on a separate port, used when the bot is not running a webhook server"""
+    app = web.Application()
+    setup_metrics_route(app)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, host=host, port=port).start()
+    return runner
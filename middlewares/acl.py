@@ -3,11 +3,14 @@ from typing import Callable, Dict, Any, Awaitable
 from aiogram import BaseMiddleware
 from aiogram.types import TelegramObject
 
-from database.models import User
-from database.orm_query import orm_get_user, orm_add_user
+from database.cache import UserCache, user_cache
+from database.orm_query import orm_add_user
 
 
 class ACLMiddleware(BaseMiddleware):
+    def __init__(self, cache: UserCache = user_cache):
+        self.cache = cache
+
     async def __call__(
             self,
             handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
@@ -16,12 +19,12 @@ class ACLMiddleware(BaseMiddleware):
 
     ) -> Any:
         user_from_event = data["event_from_user"]
-        session = data["session"]
-        user: User = await orm_get_user(session, user_from_event.id)
-        if user is None:
-            await orm_add_user(session, user_from_event.id)
-            return await handler(event, data)
-        elif not user.is_banned:
+        is_banned = self.cache.get(user_from_event.id)
+        if is_banned is None:
+            # Registers unknown users and caches the status
+            is_banned = await orm_add_user(data["session"], user_from_event.id)
+
+        if not is_banned:
             return await handler(event, data)
         else:
             return
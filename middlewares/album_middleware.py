@@ -1,58 +1,94 @@
 import asyncio
+import logging
+from collections import deque
 from typing import Any, Dict, Union
 
 from aiogram import BaseMiddleware
 from aiogram.types import Message
 
+from metrics import ALBUM_ASSEMBLY_SECONDS
+
 
 class AlbumMiddleware(BaseMiddleware):
-    def __init__(self, latency: Union[int, float] = 0.1):
+    """
+    Collects the parts of a media group and calls the handler once with data["album"].
+
+    The first part of a group waits until no new parts arrive for `latency` seconds (but not longer than
+    `max_wait`), the other parts only move this deadline and return immediately.
+    At most `max_groups` groups are buffered at the same time, parts of new groups above the limit are dropped.
+    """
+
+    def __init__(self, latency: Union[int, float] = 0.1, max_wait: Union[int, float] = 5,
+                 max_groups: int = 1_000, max_parts: int = 10):
         self.latency = latency
+        self.max_wait = max_wait
+        self.max_groups = max_groups
+        self.max_parts = max_parts  # Telegram albums have up to 10 items
         self.album_data = {}
-#
-    def collect_album_messages(self, event: Message):
-        """
-        Collect messages of the same media group.
-        """
-#         # Check if media_group_id exists in album_data
-        if event.media_group_id not in self.album_data:
-#             # Create a new entry for the media group
-            self.album_data[event.media_group_id] = {"messages": []}
-#
-#         # Append the new message to the media group
-        self.album_data[event.media_group_id]["messages"].append(event)
-#
-#         # Return the total number of messages in the current media group
-        return len(self.album_data[event.media_group_id]["messages"])
-#
+
+        # Metrics
+        self.assembled = 0
+        self.dropped = 0
+        self.assembly_latencies = deque(maxlen=1_000)
+
+    @property
+    def buffered_groups(self) -> int:
+        return len(self.album_data)
+
+    def stats(self) -> dict:
+        latencies = sorted(self.assembly_latencies)
+        return {
+            "buffered_groups": self.buffered_groups,
+            "assembled": self.assembled,
+            "dropped": self.dropped,
+            "assembly_latency_p50": latencies[len(latencies) // 2] if latencies else 0.0,
+            "assembly_latency_max": latencies[-1] if latencies else 0.0,
+        }
+
     async def __call__(self, handler, event: Message, data: Dict[str, Any]) -> Any:
         """
         Main middleware logic.
         """
-#         # If the event has no media_group_id, pass it to the handler immediately
+        # If the event has no media_group_id, pass it to the handler immediately
         if not event.media_group_id:
             return await handler(event, data)
-#
-#         # Collect messages of the same media group
-        total_before = self.collect_album_messages(event)
-#
-#         # Wait for a specified latency period
-        await asyncio.sleep(self.latency)
-#
-#         # Check the total number of messages after the latency
-        total_after = len(self.album_data[event.media_group_id]["messages"])
-#
-#         # If new messages were added during the latency, exit
-        if total_before != total_after:
+
+        loop = asyncio.get_running_loop()
+
+        # The group is already being collected: add the message and move the deadline
+        group = self.album_data.get(event.media_group_id)
+        if group is not None:
+            if len(group["messages"]) < self.max_parts:
+                group["messages"].append(event)
+                group["deadline"] = loop.time() + self.latency
+            return
+
+        if len(self.album_data) >= self.max_groups:
+            self.dropped += 1
+            logging.warning(f"Album buffer is full ({self.max_groups} groups), media group {event.media_group_id} "
+                            f"is dropped")
             return
-#
-#         # Sort the album messages by message_id and add to data
-        album_messages = self.album_data[event.media_group_id]["messages"]
+
+        # The first message of the group waits for the others
+        started = loop.time()
+        group = {"messages": [event], "deadline": started + self.latency}
+        self.album_data[event.media_group_id] = group
+        try:
+            while (delay := min(group["deadline"], started + self.max_wait) - loop.time()) > 0:
+                await asyncio.sleep(delay)
+        finally:
+            # Remove the media group from tracking to free up memory, even if the wait was cancelled
+            del self.album_data[event.media_group_id]
+
+        self.assembled += 1
+        assembly_latency = loop.time() - started
+        self.assembly_latencies.append(assembly_latency)
+        ALBUM_ASSEMBLY_SECONDS.observe(assembly_latency)
+
+        # Sort the album messages by message_id and add to data
+        album_messages = group["messages"]
         album_messages.sort(key=lambda x: x.message_id)
         data["album"] = album_messages
-#
-#         # Remove the media group from tracking to free up memory
-        del self.album_data[event.media_group_id]
-#         # Call the original event handler
+
+        # Call the original event handler
         return await handler(event, data)
-#
\ No newline at end of file
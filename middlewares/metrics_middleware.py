@@ -0,0 +1,50 @@
+import time
+from typing import Any, Awaitable, Callable, Dict
+
+from aiogram import BaseMiddleware, Bot
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware, NextRequestMiddlewareType
+from aiogram.methods import Response, TelegramMethod
+from aiogram.methods.base import TelegramType
+from aiogram.types import TelegramObject
+
+from metrics import BOT_API_ERRORS, BOT_API_SECONDS, HANDLER_SECONDS
+
+
+class HandlerMetricsMiddleware(BaseMiddleware):
+    """
+    Registered on the dispatcher observers, so it wraps the middlewares of all routers and the handler.
+    Observes the time by the router and the handler that processed the event.
+    """
+
+    async def __call__(
+            self,
+            handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+            event: TelegramObject,
+            data: Dict[str, Any],
+    ) -> Any:
+        started = time.perf_counter()
+        try:
+            return await handler(event, data)
+        finally:
+            HANDLER_SECONDS.labels(data["event_router"].name, data["handler"].callback.__name__).observe(
+                time.perf_counter() - started)
+
+
+class BotApiMetricsMiddleware(BaseRequestMiddleware):
+    """Bot session middleware, observes the time of each Bot API request by method"""
+
+    async def __call__(
+            self,
+            make_request: NextRequestMiddlewareType[TelegramType],
+            bot: Bot,
+            method: TelegramMethod[TelegramType],
+    ) -> Response[TelegramType]:
+        method_name = method.__api_method__
+        started = time.perf_counter()
+        try:
+            return await make_request(bot, method)
+        except Exception as e:
+            BOT_API_ERRORS.labels(method_name, type(e).__name__).inc()
+            raise
+        finally:
+            BOT_API_SECONDS.labels(method_name).observe(time.perf_counter() - started)
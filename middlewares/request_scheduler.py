@@ -0,0 +1,139 @@
+import asyncio
+import heapq
+import itertools
+import logging
+import random
+import time
+from contextvars import ContextVar
+from enum import IntEnum
+
+from aiogram import Bot
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware, NextRequestMiddlewareType
+from aiogram.exceptions import TelegramNetworkError, TelegramRetryAfter, TelegramServerError
+from aiogram.methods import Response, SendMediaGroup, TelegramMethod
+from aiogram.methods.base import TelegramType
+from cachetools import TTLCache
+
+
+class Priority(IntEnum):
+    INTERACTIVE = 0
+    BACKGROUND = 1
+
+
+# Priority of the requests made by the current task, background jobs set it to Priority.BACKGROUND
+request_priority: ContextVar[Priority] = ContextVar('request_priority', default=Priority.INTERACTIVE)
+
+
+class RateGate:
+    """
+    Token bucket with a priority queue in front of it.
+    Only the first waiter in the queue (the lowest priority value, then the oldest) may take tokens.
+    """
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+        self.waiters = []
+        self.counter = itertools.count()
+
+    def block(self, seconds: float):
+        """Stops giving tokens for `seconds`, used when Telegram answers with retry_after"""
+        self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+
+    def delay(self, weight: float) -> float:
+        """Seconds until `weight` tokens are available"""
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+        delay = self.blocked_until - now
+        # Requests heavier than the bucket wait for a full bucket and leave it in debt
+        needed = min(weight, self.capacity)
+        if self.tokens < needed:
+            delay = max(delay, (needed - self.tokens) / self.rate)
+        return max(delay, 0.0)
+
+    async def acquire(self, priority: Priority, weight: float = 1):
+        waiter = (priority, next(self.counter), asyncio.Event())
+        heapq.heappush(self.waiters, waiter)
+        try:
+            while True:
+                if self.waiters[0] is not waiter:
+                    waiter[2].clear()
+                    await waiter[2].wait()
+                    continue
+
+                delay = self.delay(weight)
+                if delay <= 0:
+                    self.tokens -= weight
+                    return
+                # A waiter with a higher priority may arrive meanwhile, so the head is checked again after sleep
+                await asyncio.sleep(delay)
+        finally:
+            self.waiters.remove(waiter)
+            heapq.heapify(self.waiters)
+            if self.waiters:
+                self.waiters[0][2].set()
+
+
+class RequestScheduler(BaseRequestMiddleware):
+    """
+    Bot session middleware that keeps outgoing requests within Telegram limits.
+
+    Requests addressed to a chat pass a per-chat and a global rate gate; interactive requests go first.
+    On TelegramRetryAfter the chat is paused for retry_after seconds and the request is repeated,
+    network and server errors are retried with exponential backoff and jitter.
+    Requests without chat_id (getUpdates, answerCallbackQuery, ...) are not limited.
+    """
+
+    def __init__(self, global_rate: float = 30, chat_rate: float = 1, chat_burst: float = 3,
+                 max_retries: int = 3, backoff: float = 0.5):
+        self.global_gate = RateGate(rate=global_rate, capacity=global_rate)
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.chat_gates = TTLCache(maxsize=10_000, ttl=60)
+        self.max_retries = max_retries
+        self.backoff = backoff
+
+    def chat_gate(self, chat_id: int | str) -> RateGate:
+        gate = self.chat_gates.get(chat_id)
+        if gate is None:
+            gate = RateGate(rate=self.chat_rate, capacity=self.chat_burst)
+        # Setting the item again keeps gates of active chats in the cache
+        self.chat_gates[chat_id] = gate
+        return gate
+
+    async def __call__(
+            self,
+            make_request: NextRequestMiddlewareType[TelegramType],
+            bot: Bot,
+            method: TelegramMethod[TelegramType],
+    ) -> Response[TelegramType]:
+        chat_id = getattr(method, 'chat_id', None)
+        if chat_id is None:
+            return await make_request(bot, method)
+
+        priority = request_priority.get()
+        # Telegram counts every message of an album
+        weight = len(method.media) if isinstance(method, SendMediaGroup) else 1
+
+        for attempt in range(self.max_retries + 1):
+            gate = self.chat_gate(chat_id)
+            await gate.acquire(priority, weight)
+            await self.global_gate.acquire(priority, weight)
+            try:
+                return await make_request(bot, method)
+            except TelegramRetryAfter as e:
+                if attempt == self.max_retries:
+                    raise
+                logging.warning(f"Flood control on {type(method).__name__} in chat {chat_id}, "
+                                f"retry after {e.retry_after}s")
+                gate.block(e.retry_after + random.uniform(0, self.backoff))
+            except (TelegramNetworkError, TelegramServerError) as e:
+                if attempt == self.max_retries:
+                    raise
+                logging.warning(f"{type(method).__name__} failed: {e}, retrying")
+                await asyncio.sleep(self.backoff * 2 ** attempt + random.uniform(0, self.backoff))
@@ -3,15 +3,18 @@ from typing import Any, Awaitable, Callable, Dict
 from aiogram import BaseMiddleware
 from aiogram.dispatcher.flags import get_flag
 from aiogram.types import Message
-from cachetools import TTLCache
 
-from config import THROTTLE_TIME, TEXT_MESSAGES
+from config import THROTTLE_TIME, THROTTLE_BURST, TEXT_MESSAGES
+from middlewares.throttle_storage import BaseThrottleStorage, MemoryThrottleStorage, TokenBucket
 
 
 class ThrottlingMiddleware(BaseMiddleware):
-    caches = {
-        "default": TTLCache(maxsize=10_000, ttl=THROTTLE_TIME)
-    }
+    def __init__(self, storage: BaseThrottleStorage | None = None, buckets: dict[str, TokenBucket] | None = None):
+        self.storage = storage or MemoryThrottleStorage()
+        # throttling_key flag of a handler -> bucket applied to each chat
+        self.buckets = buckets or {
+            "default": TokenBucket(capacity=THROTTLE_BURST, period=THROTTLE_TIME)
+        }
 
     async def __call__(
             self,
@@ -20,11 +23,9 @@ class ThrottlingMiddleware(BaseMiddleware):
             data: Dict[str, Any],
     ) -> Any:
         throttling_key = get_flag(data, "throttling_key")
-        if throttling_key is not None and throttling_key in self.caches:
-            if event.chat.id in self.caches[throttling_key]:
+        if throttling_key is not None and throttling_key in self.buckets:
+            if not await self.storage.consume(throttling_key, event.chat.id, self.buckets[throttling_key]):
                 return await event.answer(
                     TEXT_MESSAGES['throttling'],
                     show_alert=True)
-            else:
-                self.caches[throttling_key][event.chat.id] = None
         return await handler(event, data)
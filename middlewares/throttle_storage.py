@@ -0,0 +1,63 @@
+import time
+from abc import ABC, abstractmethod
+from dataclasses import dataclass
+from typing import Callable
+
+from cachetools import TTLCache
+from sqlalchemy.ext.asyncio import async_sessionmaker
+
+from database.orm_query import orm_consume_throttle_token
+
+
+@dataclass(frozen=True)
+class TokenBucket:
+    """`capacity` messages can be sent at once, after that one message every `period` seconds"""
+    capacity: int
+    period: float
+
+
+class BaseThrottleStorage(ABC):
+    @abstractmethod
+    async def consume(self, key: str, chat_id: int, bucket: TokenBucket) -> bool:
+        """Takes a token from the bucket of the chat. Returns False if the bucket is empty"""
+
+
+class MemoryThrottleStorage(BaseThrottleStorage):
+    """
+    Buckets are kept in the process memory, so the limits apply per process.
+    A bucket that has not been used for capacity * period seconds is full anyway and is dropped.
+    """
+
+    def __init__(self, maxsize: int = 100_000, clock: Callable[[], float] = time.monotonic):
+        self.maxsize = maxsize
+        self.clock = clock
+        self.caches: dict[str, TTLCache] = {}
+
+    def __len__(self):
+        return sum(len(cache) for cache in self.caches.values())
+
+    async def consume(self, key: str, chat_id: int, bucket: TokenBucket) -> bool:
+        cache = self.caches.get(key)
+        if cache is None:
+            cache = self.caches[key] = TTLCache(maxsize=self.maxsize, ttl=bucket.capacity * bucket.period,
+                                                    timer=self.clock)
+
+        now = self.clock()
+        tokens, updated = cache.get(chat_id, (bucket.capacity, now))
+        tokens = min(bucket.capacity, tokens + (now - updated) / bucket.period)
+        if tokens < 1:
+            return False
+
+        cache[chat_id] = (tokens - 1, now)
+        return True
+
+
+class PostgresThrottleStorage(BaseThrottleStorage):
+    """Buckets are shared by all bot processes; every check is one atomic upsert"""
+
+    def __init__(self, session_pool: async_sessionmaker):
+        self.session_pool = session_pool
+
+    async def consume(self, key: str, chat_id: int, bucket: TokenBucket) -> bool:
+        async with self.session_pool() as session:
+            return await orm_consume_throttle_token(session, key, chat_id, bucket.capacity, bucket.period)
@@ -1,82 +1,128 @@
-from datetime import datetime, timedelta
+import asyncio
+import time
+from collections import defaultdict
+from datetime import timedelta
 import logging
 
-from aiogram import Dispatcher, Bot
-from aiogram.fsm.storage.base import StorageKey
-from apscheduler.schedulers.asyncio import AsyncIOScheduler
+from aiogram import Bot
+from aiogram.types import Message
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker
 
-from config import ADMIN_USER_ID, TEXT_MESSAGES, MESSAGE_LIFETIME_HOURS, MESSAGE_LIFETIME_SECONDS
-from database.orm_query import orm_get_and_delete_all_suggestions, orm_extract_suggestions
+from config import TEXT_MESSAGES, MESSAGE_LIFETIME_HOURS, MESSAGE_LIFETIME_SECONDS, SWEEP_BATCH_SIZE, \
+    DUPLICATE_WINDOW_HOURS
+from database.orm_query import orm_delete_expired_suggestions, orm_delete_moderator_suggestions, \
+    orm_delete_old_fingerprints
 from keyboards.inline import create_ok_menu
+from middlewares.request_scheduler import Priority, request_priority
 
+# deleteMessages calls made at the same time by one clear or sweep
+DELETE_CONCURRENCY = 4
+# The progress message of a clear is edited not more often than this
+PROGRESS_INTERVAL_SECONDS = 3
 
-async def delete_messages_and_record(bot: Bot, session, message_ids, suggestion_id):
-    try:
-        # Clear db
-        suggestions = await orm_extract_suggestions(session, suggestion_id)
-
-        # Clear basic messages
-        await bot.delete_messages(chat_id=ADMIN_USER_ID, message_ids=message_ids)
-
-        # Clear help message;
-        # The id value for help_message is the same for all records in db, it is enough to delete the chat message once
-        await bot.delete_message(chat_id=ADMIN_USER_ID, message_id=suggestions[0].help_message)
-
-    except Exception as e:
-        logging.error(f"Error deleting a message and record: {e}")
-
-
-async def schedule_message_deletion(bot, session, message_ids: list, suggestion_id, scheduler: AsyncIOScheduler):
-    #  plan to delete the message in 47 hours
-    run_time = datetime.now() + timedelta(hours=MESSAGE_LIFETIME_HOURS, seconds=MESSAGE_LIFETIME_SECONDS)
-    scheduler.add_job(
-        delete_messages_and_record,
-        trigger='date',
-        run_date=run_time,
-        args=[bot, session, message_ids, suggestion_id]
-    )
-
-
-# async def clear_db_admin_chat(bot, session_pool, dp: Dispatcher):
-#     """Clears the admin chat and the database at a set time once a day."""
-#     async with session_pool() as session:
-#         cleared = False
-#         try:
-#             suggestions = await orm_get_and_delete_all_suggestions(session)
-#
-#             suggestions_ids = list((suggestion.mess_id for suggestion in suggestions))
-#             help_message_ids = list((suggestion.help_message for suggestion in suggestions))
-#
-#             if suggestions_ids and help_message_ids:
-#                 await bot.delete_messages(chat_id=ADMIN_USER_ID, message_ids=suggestions_ids)
-#                 await bot.delete_messages(chat_id=ADMIN_USER_ID, message_ids=help_message_ids)
-#                 cleared = True
-#
-#             # Use FSMContext to reset the state\
-#             bot_info = await bot.get_me()
-#             bot_id = bot_info.id
-#             storage_key = StorageKey(
-#                 chat_id=int(ADMIN_USER_ID),
-#                 user_id=int(ADMIN_USER_ID),
-#                 bot_id=bot_id
-#             )
-#             await dp.storage.set_state(storage_key, state=None)
-#             await dp.storage.set_data(storage_key, data={})
-#
-#             logging.info(f"Chat has been cleared at{datetime.now().time()}")
-#         except Exception as e:
-#             logging.exception(e)
-#
-#         if cleared:
-#             # Send a confirmation message
-#             await bot.send_message(
-#                 chat_id=ADMIN_USER_ID,
-#                 text=TEXT_MESSAGES['cleared'],
-#                 reply_markup=create_ok_menu()
-#             )
-#         else:
-#             await bot.send_message(
-#                 chat_id=ADMIN_USER_ID,
-#                 text=TEXT_MESSAGES['not_cleared'],
-#                 reply_markup=create_ok_menu()
-#             )
\ No newline at end of file
+
+def chunked(items: list, size: int):
+    """Splits the list into parts of at most `size` items"""
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+
+async def delete_chat_messages(bot: Bot, chat_id: int | str, message_ids: list[int]) -> int:
+    """
+    Deletes messages from the chat; Telegram accepts up to 100 ids per call, up to DELETE_CONCURRENCY calls
+    run at once. Returns the number of failed calls, failures are logged.
+    """
+    semaphore = asyncio.Semaphore(DELETE_CONCURRENCY)
+
+    async def delete(message_ids_chunk: list[int]):
+        async with semaphore:
+            await bot.delete_messages(chat_id=chat_id, message_ids=message_ids_chunk)
+
+    results = await asyncio.gather(*(delete(message_ids_chunk) for message_ids_chunk in chunked(message_ids, 100)),
+                                   return_exceptions=True)
+    errors = [result for result in results if isinstance(result, Exception)]
+    for error in errors:
+        logging.error(f"Error deleting messages in chat {chat_id}: {error}")
+    return len(errors)
+
+
+def unique_message_ids(rows) -> list[int]:
+    """mess_ids and help_message of (mess_ids, help_message) rows"""
+    message_ids = set()
+    for mess_ids, help_message in rows:
+        # Both are empty until the outbox worker has sent the suggestion
+        if mess_ids:
+            message_ids.update(mess_ids)
+        if help_message:
+            message_ids.add(help_message)
+    return sorted(message_ids)
+
+
+async def sweep_expired_suggestions(bot: Bot, session_pool: async_sessionmaker):
+    """
+    Periodic job. Deletes suggestions that are older than the message lifetime from the db
+    and their messages from the moderator chats. Works in batches, so memory does not depend on the backlog size.
+    Expiry is calculated from the `created` column, so nothing is lost on restart.
+    Fingerprints older than the duplicate window are deleted too.
+    """
+    # Deletions must not delay admin actions
+    request_priority.set(Priority.BACKGROUND)
+    lifetime = timedelta(hours=MESSAGE_LIFETIME_HOURS, seconds=MESSAGE_LIFETIME_SECONDS)
+
+    while True:
+        async with session_pool() as session:
+            rows = await orm_delete_expired_suggestions(session, lifetime, SWEEP_BATCH_SIZE)
+
+        if not rows:
+            break
+
+        rows_by_moderator = defaultdict(list)
+        for moderator_id, mess_ids, help_message in rows:
+            rows_by_moderator[moderator_id].append((mess_ids, help_message))
+
+        for moderator_id, moderator_rows in rows_by_moderator.items():
+            await delete_chat_messages(bot, moderator_id, unique_message_ids(moderator_rows))
+
+        logging.info(f"{len(rows)} expired suggestions have been deleted")
+
+        if len(rows) < SWEEP_BATCH_SIZE:
+            break
+
+    if DUPLICATE_WINDOW_HOURS:
+        await sweep_old_fingerprints(session_pool, timedelta(hours=DUPLICATE_WINDOW_HOURS))
+
+
+async def sweep_old_fingerprints(session_pool: async_sessionmaker, window: timedelta):
+    deleted = SWEEP_BATCH_SIZE
+    while deleted == SWEEP_BATCH_SIZE:
+        async with session_pool() as session:
+            deleted = await orm_delete_old_fingerprints(session, window, SWEEP_BATCH_SIZE)
+
+
+async def clear_moderator_chat(message: Message, session: AsyncSession):
+    """
+    Deletes all suggestions of the moderator chat the message came from, from the db and from the chat.
+    Rows are deleted in batches of SWEEP_BATCH_SIZE with DELETE ... RETURNING, so memory does not depend
+    on the number of suggestions; progress is shown by editing one message.
+    """
+    progress = await message.answer(TEXT_MESSAGES['clearing'].format(0))
+    last_progress = time.monotonic()
+    deleted = failed = 0
+
+    while True:
+        rows = await orm_delete_moderator_suggestions(session, message.chat.id, SWEEP_BATCH_SIZE)
+        if not rows:
+            break
+
+        failed += await delete_chat_messages(message.bot, message.chat.id, unique_message_ids(rows))
+        deleted += len(rows)
+
+        if len(rows) < SWEEP_BATCH_SIZE:
+            break
+        if time.monotonic() - last_progress >= PROGRESS_INTERVAL_SECONDS:
+            last_progress = time.monotonic()
+            await progress.edit_text(TEXT_MESSAGES['clearing'].format(deleted))
+
+    logging.info(f"Chat {message.chat.id} has been cleared: {deleted} suggestions deleted, {failed} calls failed")
+    await progress.edit_text(TEXT_MESSAGES['cleared' if not failed else 'not_cleared'],
+                             reply_markup=create_ok_menu())
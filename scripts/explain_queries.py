@@ -0,0 +1,128 @@
+"""
+Prints EXPLAIN plans of the statements issued by every orm_query function against a seeded dataset.
+
+Usage (from the project root, against a development database):
+    python -m scripts.explain_queries [suggestions_count]
+
+Test data is inserted inside a transaction that is rolled back at the end, and every function runs
+in its own savepoint, so the database is left as it was (except for sequence values).
+"""
+import asyncio
+import contextvars
+import sys
+from datetime import timedelta
+
+from sqlalchemy import event, text
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from database import orm_query
+from database.models import SuggestionKind, SuggestionStatus
+from database.engine import engine, create_db
+
+SUGGESTIONS_COUNT = 100_000
+USERS_COUNT = 20_000
+MODERATOR_IDS = [1, 2, 3, 4]
+
+# Name of the orm function whose statements are being explained
+current_query = contextvars.ContextVar('current_query', default=None)
+
+# orm_query function name -> call with arguments that hit existing rows of the seeded dataset
+QUERIES = {
+    'orm_add_user': lambda s: orm_query.orm_add_user(s, USERS_COUNT + 1),
+    'orm_get_user': lambda s: orm_query.orm_get_user(s, 100),
+    'orm_get_recent_users': lambda s: orm_query.orm_get_recent_users(s, 10_000),
+    'orm_next_suggestion_id': lambda s: orm_query.orm_next_suggestion_id(s),
+    'orm_next_suggestion_id_and_moderator': lambda s: orm_query.orm_next_suggestion_id_and_moderator(
+        s, MODERATOR_IDS),
+    'orm_remember_fingerprint': lambda s: orm_query.orm_remember_fingerprint(s, 100, 'f' * 32, timedelta(hours=24)),
+    'orm_delete_old_fingerprints': lambda s: orm_query.orm_delete_old_fingerprints(s, timedelta(hours=24), 500),
+    'orm_add_new_suggestion': lambda s: orm_query.orm_add_new_suggestion(s, 100, 1, 10**9, SuggestionKind.TEXT),
+    'orm_get_banned_users_page': lambda s: orm_query.orm_get_banned_users_page(s, 51, after=5_000),
+    'orm_get_banned_users_page (prev)': lambda s: orm_query.orm_get_banned_users_page(s, 51, before=5_000),
+    'orm_count_banned_users': lambda s: orm_query.orm_count_banned_users(s, 10_001),
+    'orm_block_user_by_sug_id': lambda s: orm_query.orm_block_user_by_sug_id(s, 100),
+    'orm_unblock_user': lambda s: orm_query.orm_unblock_user(s, 50),
+    'orm_claim_suggestion': lambda s: orm_query.orm_claim_suggestion(s, 100, SuggestionStatus.POSTING),
+    'orm_get_suggestion_status': lambda s: orm_query.orm_get_suggestion_status(s, 100),
+    'orm_get_suggestion': lambda s: orm_query.orm_get_suggestion(s, 100),
+    'orm_delete_expired_suggestions': lambda s: orm_query.orm_delete_expired_suggestions(
+        s, timedelta(hours=47), 500),
+    'orm_consume_throttle_token': lambda s: orm_query.orm_consume_throttle_token(s, 'default', 100, 1, 300),
+    'orm_get_fsm_records': lambda s: orm_query.orm_get_fsm_records(s, ['fsm:1:1:default', 'fsm:2:2:default']),
+    'orm_save_fsm_records': lambda s: orm_query.orm_save_fsm_records(
+        s, {'fsm:1:1:default': ('EditMessage:edit_text', {'suggestion_id': 100}), 'fsm:2:2:default': (None, {})}),
+    'orm_claim_outbox_messages': lambda s: orm_query.orm_claim_outbox_messages(s, 50, timedelta(seconds=120), 5),
+    'orm_save_outbox_progress': lambda s: orm_query.orm_save_outbox_progress(s, 1, [[1, 2, 3]]),
+    'orm_retry_outbox_message': lambda s: orm_query.orm_retry_outbox_message(s, 1, timedelta(seconds=2), 'error'),
+    'orm_delete_outbox_message': lambda s: orm_query.orm_delete_outbox_message(s, 1),
+    'orm_delete_dead_outbox_messages': lambda s: orm_query.orm_delete_dead_outbox_messages(s, 5, 500),
+    'orm_delete_undelivered_suggestions': lambda s: orm_query.orm_delete_undelivered_suggestions(s, [100, 101]),
+    'orm_finish_failed_posts': lambda s: orm_query.orm_finish_failed_posts(s, [100], [101]),
+    'orm_complete_forward': lambda s: orm_query.orm_complete_forward(s, 1, 100, [1, 2, 3], 4),
+    'orm_complete_post': lambda s: orm_query.orm_complete_post(s, 1, 100),
+    'orm_delete_moderator_suggestions': lambda s: orm_query.orm_delete_moderator_suggestions(s, 1, 500),
+}
+
+
+def explain(conn, cursor, statement, parameters, context, executemany):
+    """Runs EXPLAIN for a statement right before it is executed"""
+    name = current_query.get()
+    if name is None or not statement.lstrip().upper().startswith(('SELECT', 'INSERT', 'UPDATE', 'DELETE', 'WITH')):
+        return
+
+    cursor.execute('EXPLAIN ' + statement, parameters)
+    plan = '\n'.join(f'    {row[0]}' for row in cursor.fetchall())
+    print(f'-- {name}\n{statement}\n{plan}\n')
+
+
+async def seed(conn, suggestions_count: int):
+    users_count = max(USERS_COUNT, suggestions_count // 5)
+    await conn.execute(text(
+        "INSERT INTO users (user_id, is_banned, created, updated) "
+        "SELECT g, g % 50 = 0, now(), now() FROM generate_series(1, :users_count) g"
+    ), {'users_count': users_count})
+    # Albums of three photos, created evenly over the last two days and spread between MODERATOR_IDS
+    await conn.execute(text(
+        "INSERT INTO suggestions (suggestion_id, kind, user_id, moderator_id, mess_ids, help_message, created, updated) "
+        "SELECT g, 'album', g % :users_count + 1, g % 4 + 1, ARRAY[g * 4, g * 4 + 1, g * 4 + 2], g * 4 + 3, "
+        "now() - (g * interval '48 hours' / :suggestions_count), now() "
+        "FROM generate_series(1, :suggestions_count) g"
+    ), {'users_count': users_count, 'suggestions_count': suggestions_count})
+    # A fingerprint for every suggestion, the older half is out of a 24 hours duplicate window
+    await conn.execute(text(
+        "INSERT INTO suggestion_fingerprints (user_id, fingerprint, created, updated) "
+        "SELECT g % :users_count + 1, md5(g::text), now() - (g * interval '48 hours' / :suggestions_count), now() "
+        "FROM generate_series(1, :suggestions_count) g"
+    ), {'users_count': users_count, 'suggestions_count': suggestions_count})
+    await conn.execute(text("ANALYZE users"))
+    await conn.execute(text("ANALYZE suggestions"))
+    await conn.execute(text("ANALYZE suggestion_fingerprints"))
+
+
+async def main(suggestions_count: int):
+    await create_db()
+    event.listen(engine.sync_engine, 'before_cursor_execute', explain)
+
+    async with engine.connect() as conn:
+        transaction = await conn.begin()
+        await seed(conn, suggestions_count)
+
+        for name, call in QUERIES.items():
+            savepoint = await conn.begin_nested()
+            session = AsyncSession(bind=conn, join_transaction_mode='create_savepoint', expire_on_commit=False)
+            token = current_query.set(name)
+            try:
+                await call(session)
+            finally:
+                current_query.reset(token)
+                await session.close()
+                await savepoint.rollback()
+
+        await transaction.rollback()
+
+    await engine.dispose()
+
+
+if __name__ == '__main__':
+    engine.echo = False
+    asyncio.run(main(int(sys.argv[1]) if len(sys.argv) > 1 else SUGGESTIONS_COUNT))
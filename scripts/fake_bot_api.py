@@ -0,0 +1,96 @@
+"""
+A local imitation of the Telegram Bot API for testing flood control handling.
+
+Answers every method with a plausible result and returns 429 "Too Many Requests" when a chat gets more
+than CHAT_LIMIT messages per second or the bot more than GLOBAL_LIMIT messages per second.
+
+Usage:
+    python -m scripts.fake_bot_api [port]
+    TELEGRAM_API_URL=http://localhost:8081 python bot.py
+
+GET /stats returns the number of calls per method and the number of 429 answers.
+"""
+import asyncio
+import itertools
+import json
+import sys
+import time
+from collections import Counter, defaultdict, deque
+
+from aiohttp import web
+
+CHAT_LIMIT = 1
+GLOBAL_LIMIT = 30
+RETRY_AFTER = 1
+
+message_ids = itertools.count(1)
+calls = Counter()
+sent = defaultdict(deque)  # chat_id (or None for the whole bot) -> timestamps of the last second
+
+
+def is_flood(chat_id) -> bool:
+    now = time.monotonic()
+    for key, limit in ((chat_id, CHAT_LIMIT), (None, GLOBAL_LIMIT)):
+        timestamps = sent[key]
+        while timestamps and now - timestamps[0] > 1:
+            timestamps.popleft()
+        if len(timestamps) >= limit:
+            return True
+
+    sent[chat_id].append(now)
+    sent[None].append(now)
+    return False
+
+
+def fake_message(chat_id) -> dict:
+    return {"message_id": next(message_ids), "date": int(time.time()), "chat": {"id": int(chat_id), "type": "private"}}
+
+
+def fake_result(method: str, params: dict):
+    chat_id = params.get("chat_id", 0)
+    if method == "getMe":
+        return {"id": 1, "is_bot": True, "first_name": "Fake bot", "username": "fake_bot"}
+    if method == "getUpdates":
+        return []
+    if method == "sendMediaGroup":
+        return [fake_message(chat_id) for _ in json.loads(params["media"])]
+    if method == "copyMessage":
+        return {"message_id": next(message_ids)}
+    if method == "copyMessages":
+        return [{"message_id": next(message_ids)} for _ in json.loads(params["message_ids"])]
+    if method.startswith("send"):
+        return fake_message(chat_id)
+    return True
+
+
+async def handle(request: web.Request) -> web.Response:
+    method = request.match_info["method"]
+    params = dict(await request.post())
+    calls[method] += 1
+
+    if method == "getUpdates":
+        await asyncio.sleep(float(params.get("timeout", 0)))
+    elif "chat_id" in params and is_flood(params["chat_id"]):
+        calls["429"] += 1
+        return web.json_response({"ok": False,
+                                  "error_code": 429,
+                                  "description": f"Too Many Requests: retry after {RETRY_AFTER}",
+                                  "parameters": {"retry_after": RETRY_AFTER}},
+                                 status=429)
+
+    return web.json_response({"ok": True, "result": fake_result(method, params)})
+
+
+async def stats(request: web.Request) -> web.Response:
+    return web.json_response(dict(calls))
+
+
+def create_app() -> web.Application:
+    app = web.Application()
+    app.router.add_post("/bot{token}/{method}", handle)
+    app.router.add_get("/stats", stats)
+    return app
+
+
+if __name__ == "__main__":
+    web.run_app(create_app(), port=int(sys.argv[1]) if len(sys.argv) > 1 else 8081)
@@ -0,0 +1,187 @@
+"""
+Transactional outbox for the Bot API requests of suggestions.
+
+Handlers save the requests (serialized aiogram methods) in the outbox table in the same transaction as the change
+they belong to and answer the user right after the commit. OutboxWorker makes the requests in the background:
+- messages are taken in batches with a lease, so several bot processes can run workers;
+- the requests of a message are made in order, the result of each one is saved before the next one,
+  so a retry repeats at most the request that was in flight when the worker failed (delivery is at least once);
+- failed messages are retried with exponential backoff up to OUTBOX_MAX_ATTEMPTS times, then
+  sweep_dead_messages() deletes them and settles their suggestions.
+"""
+import asyncio
+import logging
+from datetime import timedelta
+
+from aiogram import Bot, methods
+from aiogram.client.default import Default
+from aiogram.methods import TelegramMethod
+from aiogram.types import Message, MessageId
+from sqlalchemy.ext.asyncio import async_sessionmaker
+
+from config import OUTBOX_BATCH_SIZE, OUTBOX_CONCURRENCY, OUTBOX_POLL_SECONDS, OUTBOX_MAX_ATTEMPTS, \
+    OUTBOX_LEASE_SECONDS, SWEEP_BATCH_SIZE
+from database.models import OutboxMessage
+from database.orm_query import orm_claim_outbox_messages, orm_save_outbox_progress, orm_retry_outbox_message, \
+    orm_delete_outbox_message, orm_complete_forward, orm_complete_post, orm_delete_dead_outbox_messages, \
+    orm_delete_undelivered_suggestions, orm_finish_failed_posts
+from metrics import OUTBOX_MESSAGES
+from middlewares.request_scheduler import Priority, request_priority
+from scripts.clear_db_admin_chat import delete_chat_messages
+
+# Kinds of outbox messages
+FORWARD = 'forward'  # the suggestion and its help message to the moderator chat
+POST = 'post'  # the suggestion to the channel, then its messages are deleted from the moderator chat
+
+MAX_RETRY_DELAY_SECONDS = 300
+
+
+def without_defaults(value):
+    """Drops None and bot defaults (parse_mode etc.), they are filled in again when the request is made"""
+    if isinstance(value, dict):
+        return {key: without_defaults(item) for key, item in value.items()
+                if item is not None and not isinstance(item, Default)}
+    if isinstance(value, list):
+        return [without_defaults(item) for item in value]
+    return value
+
+
+def dump_request(method: TelegramMethod) -> dict:
+    return {'method': type(method).__name__, 'params': without_defaults(method.model_dump(exclude_none=True))}
+
+
+def load_request(request: dict) -> TelegramMethod:
+    return getattr(methods, request['method']).model_validate(request['params'])
+
+
+def result_message_ids(result) -> list[int]:
+    if isinstance(result, list):
+        return [item.message_id for item in result]
+    if isinstance(result, (Message, MessageId)):
+        return [result.message_id]
+    return []
+
+
+class OutboxWorker:
+    def __init__(self, bot: Bot, session_pool: async_sessionmaker, batch_size: int = OUTBOX_BATCH_SIZE,
+                 concurrency: int = OUTBOX_CONCURRENCY, poll_interval: float = OUTBOX_POLL_SECONDS,
+                 max_attempts: int = OUTBOX_MAX_ATTEMPTS, lease: float = OUTBOX_LEASE_SECONDS,
+                 retry_delay: float = 1):
+        self.bot = bot
+        self.session_pool = session_pool
+        self.batch_size = batch_size
+        self.semaphore = asyncio.Semaphore(concurrency)
+        self.poll_interval = poll_interval
+        self.max_attempts = max_attempts
+        self.lease = timedelta(seconds=lease)
+        self.retry_delay = retry_delay
+        self.wakeup = asyncio.Event()
+        self.task: asyncio.Task | None = None
+
+    def notify(self):
+        """Called after a commit that added outbox messages, so they are sent without waiting for the next poll"""
+        self.wakeup.set()
+
+    def start(self):
+        self.task = asyncio.create_task(self.run())
+
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            await asyncio.gather(self.task, return_exceptions=True)
+
+    async def run(self):
+        while True:
+            self.wakeup.clear()
+            try:
+                processed = await self.run_once()
+            except Exception as e:
+                logging.exception("Outbox worker failed", exc_info=e)
+                processed = 0
+
+            # A full batch means there are probably more due messages
+            if processed == self.batch_size:
+                continue
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), timeout=self.poll_interval)
+            except asyncio.TimeoutError:
+                pass
+
+    async def run_once(self) -> int:
+        """Takes one batch of due messages and processes them. Returns the number of messages taken"""
+        async with self.session_pool() as session:
+            messages = await orm_claim_outbox_messages(session, self.batch_size, self.lease, self.max_attempts)
+
+        await asyncio.gather(*(self.process(message) for message in messages))
+        return len(messages)
+
+    async def process(self, message: OutboxMessage):
+        async with self.semaphore:
+            results = list(message.results)
+            try:
+                for request in message.requests[len(results):]:
+                    results.append(result_message_ids(await self.bot(load_request(request))))
+                    if len(results) < len(message.requests):
+                        async with self.session_pool() as session:
+                            await orm_save_outbox_progress(session, message.id, results)
+
+                async with self.session_pool() as session:
+                    await self.complete(session, message, results)
+                OUTBOX_MESSAGES.labels(message.kind, 'sent').inc()
+
+            except Exception as e:
+                OUTBOX_MESSAGES.labels(message.kind, 'failed').inc()
+                if message.attempts >= self.max_attempts:
+                    logging.exception(f"Outbox message {message.id} ({message.kind} of suggestion "
+                                      f"{message.suggestion_id}) failed {message.attempts} times, giving up",
+                                      exc_info=e)
+                else:
+                    logging.warning(f"Outbox message {message.id} failed: {e!r}, retrying")
+                delay = min(self.retry_delay * 2 ** (message.attempts - 1), MAX_RETRY_DELAY_SECONDS)
+                async with self.session_pool() as session:
+                    await orm_retry_outbox_message(session, message.id, timedelta(seconds=delay), repr(e))
+
+    async def sweep_dead_messages(self):
+        """
+        Periodic job. Deletes the messages that failed max_attempts times. A suggestion that never reached
+        the moderator chat is deleted along with the messages sent before the failure; a suggestion whose post
+        failed is pending again, or posted if only deleting it from the moderator chat failed.
+        """
+        # Deletions must not delay admin actions
+        request_priority.set(Priority.BACKGROUND)
+        while True:
+            async with self.session_pool() as session:
+                messages = await orm_delete_dead_outbox_messages(session, self.max_attempts, SWEEP_BATCH_SIZE)
+                forwards = [message for message in messages if message.kind == FORWARD]
+                posts = [message for message in messages if message.kind == POST]
+                await orm_delete_undelivered_suggestions(session, [message.suggestion_id for message in forwards])
+                await orm_finish_failed_posts(session,
+                                              [message.suggestion_id for message in posts if message.results],
+                                              [message.suggestion_id for message in posts if not message.results])
+                await session.commit()
+
+            for message in forwards:
+                sent = [message_id for message_ids in message.results for message_id in message_ids]
+                if sent:
+                    await delete_chat_messages(self.bot, message.requests[0]['params']['chat_id'], sent)
+            for message in messages:
+                OUTBOX_MESSAGES.labels(message.kind, 'dead').inc()
+            if messages:
+                logging.warning(f"{len(messages)} outbox messages failed {self.max_attempts} times and were dropped")
+
+            if len(messages) < SWEEP_BATCH_SIZE:
+                break
+
+    async def complete(self, session, message: OutboxMessage, results: list[list[int]]):
+        if message.kind == POST:
+            await orm_complete_post(session, message.id, message.suggestion_id)
+            return
+        if message.kind != FORWARD:
+            await orm_delete_outbox_message(session, message.id)
+            return
+
+        mess_ids, (help_message,) = results
+        if not await orm_complete_forward(session, message.id, message.suggestion_id, mess_ids, help_message):
+            # The suggestion was cleared or expired while it was waiting in the outbox
+            moderator_id = message.requests[0]['params']['chat_id']
+            await delete_chat_messages(self.bot, moderator_id, mess_ids + [help_message])
@@ -0,0 +1,180 @@
+"""
+Fans updates out to several worker processes.
+
+The ingress process receives the updates (long polling or webhook) and puts each one in the queue of worker
+`chat_id % processes`, so all updates of a chat go to the same worker in the order they were received.
+Every worker runs its own Dispatcher, engine and caches (see bot.run_worker) and handles the updates of different
+chats concurrently, the updates of one chat one after another in the order they were received.
+
+The queues are multiprocessing queues, so the whole setup runs on one machine:
+    WORKER_PROCESSES=4 python bot.py
+"""
+import asyncio
+import logging
+import multiprocessing
+import queue
+from typing import Any, Awaitable, Callable
+
+from aiogram import Bot
+from aiogram.methods import GetUpdates
+from aiogram.utils.backoff import Backoff, BackoffConfig
+from aiohttp import web
+
+# Put in the queues on shutdown, a worker stops after the updates before it
+STOP = None
+
+SUPERVISE_INTERVAL_SECONDS = 5
+POLLING_TIMEOUT = 30
+
+
+def update_media_group_id(update: dict) -> str | None:
+    message = update.get('message')
+    return message.get('media_group_id') if message else None
+
+
+def update_chat_id(update: dict) -> int:
+    """Id of the chat the update belongs to, or of its user for updates without a chat (inline queries etc.)"""
+    for event in update.values():
+        if not isinstance(event, dict):
+            continue
+        chat = event.get('chat') or (event.get('message') or {}).get('chat')
+        if chat:
+            return chat['id']
+        user = event.get('from') or event.get('user')
+        if user:
+            return user['id']
+    return 0
+
+
+class WorkerPool:
+    def __init__(self, target: Callable[[int, multiprocessing.Queue], Any], processes: int, queue_size: int):
+        # spawn: the workers must not inherit the event loop and the connections of the ingress
+        self.context = multiprocessing.get_context('spawn')
+        self.target = target
+        self.queues = [self.context.Queue(maxsize=queue_size) for _ in range(processes)]
+        self.processes = [self.create_process(index) for index in range(processes)]
+        self.supervise_task: asyncio.Task | None = None
+
+    def create_process(self, index: int) -> multiprocessing.Process:
+        return self.context.Process(target=self.target, args=(index, self.queues[index]), name=f'worker-{index}')
+
+    def start(self):
+        for process in self.processes:
+            process.start()
+        self.supervise_task = asyncio.create_task(self.supervise())
+
+    async def supervise(self):
+        """Restarts workers that died, their queues keep the updates they have not taken yet"""
+        while True:
+            await asyncio.sleep(SUPERVISE_INTERVAL_SECONDS)
+            for index, process in enumerate(self.processes):
+                if not process.is_alive():
+                    logging.error(f'Worker {index} exited with code {process.exitcode}, restarting')
+                    self.processes[index] = self.create_process(index)
+                    self.processes[index].start()
+
+    async def put(self, update: dict):
+        updates = self.queues[update_chat_id(update) % len(self.queues)]
+        try:
+            updates.put_nowait(update)
+        except queue.Full:
+            # The worker is behind: wait for it instead of buffering more updates in the ingress
+            await asyncio.to_thread(updates.put, update)
+
+    async def stop(self):
+        if self.supervise_task is not None:
+            self.supervise_task.cancel()
+        for updates, process in zip(self.queues, self.processes):
+            if process.is_alive():
+                await asyncio.to_thread(updates.put, STOP)
+        for process in self.processes:
+            await asyncio.to_thread(process.join)
+
+
+async def poll_updates(bot: Bot, pool: WorkerPool, allowed_updates: list[str]):
+    """Long polling loop of the ingress process"""
+    backoff = Backoff(config=BackoffConfig(min_delay=1.0, max_delay=5.0, factor=1.3, jitter=0.1))
+    get_updates = GetUpdates(timeout=POLLING_TIMEOUT, allowed_updates=allowed_updates)
+    while True:
+        try:
+            updates = await bot(get_updates, request_timeout=int(bot.session.timeout + POLLING_TIMEOUT))
+        except Exception as e:
+            logging.error(f'Failed to fetch updates: {e!r}, retrying in {backoff.next_delay:.1f}s')
+            await backoff.asleep()
+            continue
+
+        backoff.reset()
+        for update in updates:
+            await pool.put(update.model_dump(mode='json', exclude_unset=True, by_alias=True))
+            get_updates.offset = update.update_id + 1
+
+
+def setup_webhook_route(app: web.Application, pool: WorkerPool, path: str, secret_token: str | None):
+    """Webhook of the ingress process: answers Telegram as soon as the update is queued"""
+
+    async def handle(request: web.Request) -> web.Response:
+        if secret_token and request.headers.get('X-Telegram-Bot-Api-Secret-Token') != secret_token:
+            return web.Response(status=401)
+        await pool.put(await request.json())
+        return web.Response()
+
+    app.router.add_post(path, handle)
+
+
+def take_updates(updates: multiprocessing.Queue, limit: int) -> list:
+    """Blocks until there is an update, then takes the ones already queued after it"""
+    batch = [updates.get()]
+    while len(batch) < limit and batch[-1] is not STOP:
+        try:
+            batch.append(updates.get_nowait())
+        except queue.Empty:
+            break
+    return batch
+
+
+async def consume(updates: multiprocessing.Queue, handle: Callable[[dict], Awaitable], max_in_flight: int):
+    """
+    Worker loop until STOP: updates of different chats are handled concurrently, an update of a chat starts
+    when the previous update of the chat is handled.
+    The parts of an album are handled together: all of them wait for the update before the album and the update
+    after the album waits for all of them, so AlbumMiddleware can collect the parts whichever comes first.
+    """
+    semaphore = asyncio.Semaphore(max_in_flight)
+    tasks = set()
+    # chat id -> (media_group_id, tasks the last update waits for, tasks of the last update or album)
+    last_updates: dict[int, tuple[str | None, list[asyncio.Task], list[asyncio.Task]]] = {}
+
+    async def handle_update(update: dict, previous: list[asyncio.Task]):
+        try:
+            if previous:
+                # Only waits, the previous updates log their own errors
+                await asyncio.wait(previous)
+            await handle(update)
+        except Exception as e:
+            logging.exception(f'Failed to handle update {update.get("update_id")}', exc_info=e)
+        finally:
+            semaphore.release()
+
+    def forget(chat_id: int, last: list[asyncio.Task]):
+        if chat_id in last_updates and last_updates[chat_id][2] is last and all(task.done() for task in last):
+            del last_updates[chat_id]
+
+    while True:
+        for update in await asyncio.to_thread(take_updates, updates, max_in_flight):
+            if update is STOP:
+                await asyncio.gather(*tasks)
+                return
+            await semaphore.acquire()
+
+            chat_id = update_chat_id(update)
+            media_group_id = update_media_group_id(update)
+            last_group_id, waited, last = last_updates.get(chat_id, (None, [], []))
+            if media_group_id is None or media_group_id != last_group_id:
+                waited, last = last, []
+                last_updates[chat_id] = (media_group_id, waited, last)
+
+            task = asyncio.create_task(handle_update(update, waited))
+            last.append(task)
+            task.add_done_callback(lambda done, chat_id=chat_id, last=last: forget(chat_id, last))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
@@ -0,0 +1,14 @@
+"""
+Config is read from the environment on import, the tests provide what it needs.
+Tests that need PostgreSQL run against BENCH_DATABASE_URL and are skipped without it.
+"""
+import os
+
+if os.getenv("BENCH_DATABASE_URL"):
+    os.environ["DATABASE_URL"] = os.environ["BENCH_DATABASE_URL"]
+for name, value in {
+    "TOKEN": "42:test", "ADMIN_USER_ID": "1", "CHANNEL_ID": "-1001", "THROTTLE_TIME": "300",
+    "MESSAGE_LIFETIME_HOURS": "47", "MESSAGE_LIFETIME_SECONDS": "0", "LINK": "http://t.me/channel",
+    "LINK_TEXT": "MY CHANNEL", "DATABASE_URL": "postgresql+asyncpg://localhost/test",
+}.items():
+    os.environ.setdefault(name, value)
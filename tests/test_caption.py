@@ -0,0 +1,67 @@
+import random
+
+import pytest
+from aiogram.types import MessageEntity
+
+from config import LINK, LINK_TEXT
+from handlers.caption import CAPTION_LIMIT, TEXT_LIMIT, CaptionComposer, composer, utf16_length
+
+# ASCII, Cyrillic, emoji outside the BMP (two UTF-16 units each), a flag, a skin tone and a combining mark
+ALPHABET = 'abc xyz,.' + 'абв где' + '😀🎉👍🏻🇺🇦' + 'é'
+
+
+def random_texts(count: int, max_length: int = 1500):
+    rng = random.Random(0)
+    for _ in range(count):
+        yield ''.join(rng.choices(ALPHABET, k=rng.randrange(0, max_length)))
+
+
+def linked_text(text: str, entity: MessageEntity) -> str:
+    """The part of the text an entity covers, offsets and lengths are in UTF-16 code units"""
+    encoded = text.encode('utf-16-le')
+    return encoded[entity.offset * 2:(entity.offset + entity.length) * 2].decode('utf-16-le')
+
+
+def test_utf16_length():
+    for text in random_texts(500):
+        assert utf16_length(text) == len(text.encode('utf-16-le')) // 2
+    assert utf16_length('😀') == 2
+    assert utf16_length('abc') == 3
+
+
+@pytest.mark.parametrize('limit', [CAPTION_LIMIT, TEXT_LIMIT])
+def test_link_entity_covers_the_link_text(limit):
+    user_entities = [MessageEntity(type='bold', offset=0, length=1)]
+    for text in random_texts(2000):
+        composed = composer.compose(text, user_entities, limit)
+        if utf16_length(text) > composer.max_text_length(limit):
+            assert composed is None
+            continue
+
+        result, entities = composed
+        assert utf16_length(result) <= limit
+        assert entities[:-1] == (user_entities if text else [])
+        link = entities[-1]
+        assert link.type == 'text_link' and link.url == LINK
+        assert linked_text(result, link) == LINK_TEXT
+        assert result.startswith(text)
+
+
+def test_empty_text_gets_only_the_link():
+    for text in ('', None):
+        result, entities = composer.compose(text, None, CAPTION_LIMIT)
+        assert result == LINK_TEXT
+        assert [(entity.offset, entity.length) for entity in entities] == [(0, utf16_length(LINK_TEXT))]
+
+
+def test_limit_is_counted_in_utf16_units():
+    caption_composer = CaptionComposer('🔗 link', 'http://t.me/x')
+    longest = caption_composer.max_text_length(CAPTION_LIMIT)
+
+    assert caption_composer.compose('a' * longest, None, CAPTION_LIMIT) is not None
+    assert caption_composer.compose('a' * (longest + 1), None, CAPTION_LIMIT) is None
+    # One emoji less than the limit in characters, one unit more in UTF-16
+    assert caption_composer.compose('a' * (longest - 1) + '😀', None, CAPTION_LIMIT) is None
+
+    result, entities = caption_composer.compose('😀' * 10, None, CAPTION_LIMIT)
+    assert linked_text(result, entities[-1]) == '🔗 link'
@@ -0,0 +1,57 @@
+import asyncio
+import contextlib
+
+from aiogram.fsm.storage.base import StorageKey
+
+from database import fsm_storage
+from database.fsm_storage import PostgresStorage
+
+LOAD_DELAY = 0.1
+
+
+def storage_key(chat_id: int) -> StorageKey:
+    return StorageKey(bot_id=42, chat_id=chat_id, user_id=chat_id)
+
+
+def fake_storage(monkeypatch, rows: dict, **kwargs) -> tuple[PostgresStorage, list[list[str]]]:
+    """Storage whose SELECTs take LOAD_DELAY and return `rows`; the keys of every SELECT are recorded"""
+    loads = []
+
+    async def get_fsm_records(session, keys: list[str]) -> dict:
+        loads.append(keys)
+        await asyncio.sleep(LOAD_DELAY)
+        return {key: rows[key] for key in keys if key in rows}
+
+    monkeypatch.setattr(fsm_storage, 'orm_get_fsm_records', get_fsm_records)
+    storage = PostgresStorage(lambda: contextlib.nullcontext(), **kwargs)
+    return storage, loads
+
+
+def test_miss_during_a_load_is_answered(monkeypatch):
+    """A miss that comes while a batch is loading used to wait for a load task that never ran"""
+    storage, loads = fake_storage(monkeypatch, {})
+
+    async def main():
+        first = asyncio.create_task(storage.get_state(storage_key(1)))
+        await asyncio.sleep(LOAD_DELAY / 10)
+        second = asyncio.create_task(storage.get_state(storage_key(2)))
+        return await asyncio.wait_for(asyncio.gather(first, second), LOAD_DELAY * 5)
+
+    assert asyncio.run(main()) == [None, None]
+    assert len(loads) == 2
+
+
+def test_absent_keys_are_read_once(monkeypatch):
+    """Keys without a state stay cached after cache_ttl, a write replaces them"""
+    key = storage_key(1)
+    storage, loads = fake_storage(monkeypatch, {}, cache_ttl=LOAD_DELAY / 10, flush_interval=60)
+
+    async def main():
+        for _ in range(3):
+            assert await storage.get_state(key) is None
+            await asyncio.sleep(LOAD_DELAY / 5)
+        await storage.set_state(key, 'editing')
+        assert await storage.get_state(key) == 'editing'
+
+    asyncio.run(main())
+    assert loads == [[storage.key_builder.build(key)]]
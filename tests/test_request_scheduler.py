@@ -0,0 +1,75 @@
+"""RequestScheduler against scripts/fake_bot_api.py, which answers 429 above CHAT_LIMIT messages per second"""
+import asyncio
+import time
+
+from aiogram import Bot
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
+from aiohttp.test_utils import TestServer
+
+from middlewares.request_scheduler import Priority, RequestScheduler, request_priority
+from scripts import fake_bot_api
+
+CHAT_ID = 1
+
+
+async def run_with_bot(scheduler: RequestScheduler, test):
+    """Runs test(bot) with the scheduler in front of a fresh fake Bot API"""
+    fake_bot_api.calls.clear()
+    fake_bot_api.sent.clear()
+    async with TestServer(fake_bot_api.create_app()) as server:
+        bot = Bot(token='42:test',
+                  session=AiohttpSession(api=TelegramAPIServer.from_base(str(server.make_url('')))))
+        bot.session.middleware(scheduler)
+        try:
+            return await test(bot)
+        finally:
+            await bot.session.close()
+
+
+def test_flood_control_pauses_the_chat():
+    scheduler = RequestScheduler(chat_rate=100, chat_burst=100, backoff=0.01)
+
+    async def test(bot: Bot):
+        start = time.monotonic()
+        await bot.send_message(CHAT_ID, 'first')
+        # The second message within a second gets 429, the scheduler waits retry_after and repeats it
+        second = asyncio.create_task(bot.send_message(CHAT_ID, 'second'))
+        await asyncio.sleep(0.2)
+        # A message to the paused chat waits for the pause instead of getting 429 too
+        third = asyncio.create_task(bot.send_message(CHAT_ID, 'third'))
+        await asyncio.sleep(0.3)
+        assert fake_bot_api.calls['sendMessage'] == 2
+        assert fake_bot_api.calls['429'] == 1
+        # Other chats are not paused
+        await bot.send_message(CHAT_ID + 1, 'other chat')
+
+        messages = await asyncio.gather(second, third)
+        assert [message.chat.id for message in messages] == [CHAT_ID, CHAT_ID]
+        assert time.monotonic() - start >= fake_bot_api.RETRY_AFTER
+
+    asyncio.run(run_with_bot(scheduler, test))
+
+
+def test_interactive_requests_go_first(monkeypatch):
+    # The scheduler alone spaces the messages, the fake API doesn't limit them
+    monkeypatch.setattr(fake_bot_api, 'CHAT_LIMIT', 100)
+    scheduler = RequestScheduler(chat_rate=10, chat_burst=1)
+    sent = []
+
+    async def send(bot: Bot, text: str, priority: Priority):
+        # Tasks run in a copy of the context, the priority applies to this task only
+        request_priority.set(priority)
+        await bot.send_message(CHAT_ID, text)
+        sent.append(text)
+
+    async def test(bot: Bot):
+        # Takes the only token, the next messages queue at the chat gate
+        await bot.send_message(CHAT_ID, 'first')
+        background = [asyncio.create_task(send(bot, f'background {i}', Priority.BACKGROUND)) for i in range(3)]
+        await asyncio.sleep(0.01)
+        interactive = asyncio.create_task(send(bot, 'interactive', Priority.INTERACTIVE))
+        await asyncio.gather(*background, interactive)
+
+    asyncio.run(run_with_bot(scheduler, test))
+    assert sent == ['interactive', 'background 0', 'background 1', 'background 2']
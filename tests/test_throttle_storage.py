@@ -0,0 +1,85 @@
+"""
+The memory buckets run on a fake clock. The PostgreSQL upsert runs against BENCH_DATABASE_URL
+and is skipped without it (only the rows added here are deleted).
+"""
+import asyncio
+import os
+
+import pytest
+from sqlalchemy import delete
+
+from database.engine import create_db, engine, session_maker
+from database.models import ThrottleBucket
+from middlewares.throttle_storage import MemoryThrottleStorage, PostgresThrottleStorage, TokenBucket
+
+BUCKET = TokenBucket(capacity=3, period=10)
+CHAT_ID = -42  # no real chat has this id, the rows of the test are easy to find
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+def consume_many(storage, count: int, bucket: TokenBucket = BUCKET, chat_id: int = CHAT_ID) -> list[bool]:
+    async def main():
+        return [await storage.consume('test', chat_id, bucket) for _ in range(count)]
+
+    return asyncio.run(main())
+
+
+def test_memory_bucket_refills():
+    clock = FakeClock()
+    storage = MemoryThrottleStorage(clock=clock)
+
+    assert consume_many(storage, 4) == [True, True, True, False]
+    # Another chat has its own bucket
+    assert consume_many(storage, 1, chat_id=CHAT_ID - 1) == [True]
+
+    clock.now += BUCKET.period / 2
+    assert consume_many(storage, 1) == [False]
+    clock.now += BUCKET.period / 2
+    assert consume_many(storage, 2) == [True, False]
+
+    # An unused bucket fills up to the capacity, not beyond
+    clock.now += BUCKET.period * 100
+    assert consume_many(storage, 4) == [True, True, True, False]
+
+
+def test_memory_denials_do_not_delay_the_refill():
+    clock = FakeClock()
+    storage = MemoryThrottleStorage(clock=clock)
+    consume_many(storage, BUCKET.capacity)
+
+    for _ in range(9):
+        clock.now += BUCKET.period / 10
+        assert consume_many(storage, 1) == [False]
+    clock.now += BUCKET.period / 10
+    assert consume_many(storage, 1) == [True]
+
+
+@pytest.mark.skipif(not os.getenv("BENCH_DATABASE_URL"), reason="BENCH_DATABASE_URL is not set")
+def test_postgres_bucket():
+    storage = PostgresThrottleStorage(session_maker)
+    fast = TokenBucket(capacity=2, period=0.5)
+
+    async def main():
+        await create_db()
+        try:
+            # Concurrent checks of one chat never take more tokens than the bucket has
+            consumed = await asyncio.gather(*(storage.consume('test', CHAT_ID, BUCKET) for _ in range(20)))
+            assert consumed.count(True) == BUCKET.capacity
+
+            assert [await storage.consume('fast', CHAT_ID, fast) for _ in range(3)] == [True, True, False]
+            await asyncio.sleep(fast.period)
+            assert [await storage.consume('fast', CHAT_ID, fast) for _ in range(2)] == [True, False]
+        finally:
+            async with engine.begin() as conn:
+                await conn.execute(delete(ThrottleBucket).where(ThrottleBucket.chat_id == CHAT_ID))
+            # The pool belongs to the event loop of this run
+            await engine.dispose()
+
+    asyncio.run(main())
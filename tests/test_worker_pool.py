@@ -0,0 +1,63 @@
+import asyncio
+import queue
+import random
+
+from scripts.worker_pool import STOP, consume, update_chat_id
+
+
+def message_update(update_id: int, chat_id: int, media_group_id: str | None = None) -> dict:
+    message = {'message_id': update_id, 'chat': {'id': chat_id}}
+    if media_group_id:
+        message['media_group_id'] = media_group_id
+    return {'update_id': update_id, 'message': message}
+
+
+def run_consume(updates: list[dict], seed: int) -> list[tuple]:
+    """Handles the updates with random delays; album parts are collected like AlbumMiddleware does"""
+    rng = random.Random(seed)
+    delays = {update['update_id']: rng.random() / 100 for update in updates}
+    queued = queue.Queue()
+    for update in updates:
+        queued.put(update)
+    queued.put(STOP)
+
+    handled = []
+    albums = {}
+
+    async def handle(update: dict):
+        message = update['message']
+        await asyncio.sleep(delays[update['update_id']])
+        group_id = message.get('media_group_id')
+        if group_id is None:
+            handled.append((message['chat']['id'], message['message_id']))
+            return
+        parts = albums.setdefault(group_id, [])
+        parts.append(message['message_id'])
+        if len(parts) == 1:
+            await asyncio.sleep(0.05)
+            handled.append((message['chat']['id'], min(parts), len(parts)))
+
+    asyncio.run(consume(queued, handle, max_in_flight=100))
+    return handled
+
+
+def test_updates_of_a_chat_are_handled_in_order():
+    updates = []
+    for i in range(20):
+        updates += [message_update(len(updates) + 1, 1), message_update(len(updates) + 2, 2)]
+    updates += [message_update(len(updates) + i + 1, 1, 'album') for i in range(3)]
+    updates += [message_update(len(updates) + 1, 1), message_update(len(updates) + 2, 2)]
+
+    for seed in range(10):
+        handled = run_consume(updates, seed)
+        for chat_id in (1, 2):
+            message_ids = [item[1] for item in handled if item[0] == chat_id]
+            assert message_ids == sorted(message_ids)
+        # The album is handled once, with all its parts
+        assert [item[2] for item in handled if len(item) == 3] == [3]
+
+
+def test_update_chat_id():
+    assert update_chat_id(message_update(1, 5)) == 5
+    assert update_chat_id({'update_id': 1, 'callback_query': {'from': {'id': 7}, 'message': {'chat': {'id': 9}}}}) == 9
+    assert update_chat_id({'update_id': 1, 'inline_query': {'from': {'id': 7}}}) == 7